@@ -0,0 +1,168 @@
+"""
+Cold start benchmark for the room controller
+
+Boots a RoomController in a fresh process against a temporary database with every cloud service stubbed out,
+each stubbed network call sleeps for a fixed latency so the effect of slow services on startup is repeatable.
+Run from the repository root:
+    python Benchmarks/cold_start.py --runs 5 --latency 0.5
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SECRETS = {
+    "openweathermap": "stub",
+    "VesyncUsername": "stub",
+    "VesyncPassword": "stub",
+    "govee_key": "stub",
+    "MagicHueUsername": "stub",
+    "MagicHuePassword": "stub",
+    "VoiceMonkeyKey": "stub",
+    "VoiceMonkeySecret": "stub",
+}
+
+
+class StubResponse:
+    status_code = 200
+    content = b""
+    text = "{}"
+
+    def json(self):
+        return {"data": [], "host": "", "radar": {"past": [], "nowcast": []}, "payload": {"capabilities": []}}
+
+
+def install_cloud_stubs(latency):
+    """Replace the cloud service libraries with stubs that take `latency` seconds per network call"""
+
+    def network_call(result=None):
+        def call(*args, **kwargs):
+            time.sleep(latency)
+            return result
+        return call
+
+    requests = types.ModuleType("requests")
+    requests.get = network_call(StubResponse())
+    requests.post = network_call(StubResponse())
+    sys.modules["requests"] = requests
+
+    geocoder = types.ModuleType("geocoder")
+    geocoder.ip = network_call(types.SimpleNamespace(address="Stubbed", latlng=[42.0, -83.0]))
+    sys.modules["geocoder"] = geocoder
+
+    class WeatherManager:
+        one_call = staticmethod(network_call(types.SimpleNamespace(forecast_hourly=[])))
+
+        @staticmethod
+        def weather_at_coords(*args):
+            time.sleep(latency)
+            raise RuntimeError("Current weather is stubbed")
+
+    pyowm = types.ModuleType("pyowm")
+    pyowm.owm = types.ModuleType("pyowm.owm")
+    pyowm.owm.OWM = lambda api_key: types.SimpleNamespace(weather_manager=WeatherManager)
+    sys.modules["pyowm"] = pyowm
+    sys.modules["pyowm.owm"] = pyowm.owm
+
+    class VeSync:
+        def __init__(self, *args, **kwargs):
+            self.outlets = []
+
+        login = network_call(True)
+        update = network_call()
+
+    pyvesync = types.ModuleType("pyvesync")
+    pyvesync.VeSync = VeSync
+    sys.modules["pyvesync"] = pyvesync
+
+    class MagicHueAPIError(Exception):
+        pass
+
+    magichue = types.ModuleType("magichue")
+    magichue.light = types.SimpleNamespace(bulb_types=int)
+    magichue.exceptions = types.SimpleNamespace(MagicHueAPIError=MagicHueAPIError)
+    magichue.RemoteAPI = types.SimpleNamespace(
+        login_with_user_password=network_call(types.SimpleNamespace(get_all_devices=network_call([]))))
+    magichue.RemoteLight = None
+    sys.modules["magichue"] = magichue
+
+
+def seed_database(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS secrets (secret_name TEXT, secret_value TEXT)")
+    connection.executemany("INSERT INTO secrets (secret_name, secret_value) VALUES (?, ?)", SECRETS.items())
+    connection.commit()
+    connection.close()
+
+
+def single_run(latency):
+    """Boot the room controller once in this process and print the startup report as json"""
+    work_dir = tempfile.mkdtemp(prefix="room_control_bench_")
+    # Modules are discovered relative to the working directory, link them in so caches and logs stay in work_dir
+    os.symlink(os.path.join(REPO_ROOT, "Modules"), os.path.join(work_dir, "Modules"))
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_ROOT)
+
+    from loguru import logger as logging
+    logging.remove()
+    logging.add(sys.stderr, level="WARNING")
+
+    install_cloud_stubs(latency)
+    db_path = os.path.join(work_dir, "room_data.db")
+    seed_database(db_path)
+
+    from Modules.StartupProfiler import startup_profiler
+    with startup_profiler.phase("import"):
+        from Modules import RoomControl
+    with startup_profiler.phase("room_controller"):
+        RoomControl.RoomController(db_path)
+    print(json.dumps(startup_profiler.report()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts to measure")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds each stubbed network call takes")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        single_run(args.latency)
+        os._exit(0)  # Don't wait on the module background threads
+
+    reports = []
+    for run in range(args.runs):
+        # Every run is a new interpreter so module imports are measured cold
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", "--latency", str(args.latency)],
+                                capture_output=True, text=True, cwd=REPO_ROOT)
+        if result.returncode != 0:
+            print(result.stderr, file=sys.stderr)
+            sys.exit(f"Run {run + 1} failed")
+        reports.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    print(f"Cold start over {len(reports)} runs with {args.latency}s stubbed network latency (median seconds)")
+    phases = reports[0]["phases"].keys()
+    for phase in phases:
+        print(f"  {phase:<24}{statistics.median(report['phases'][phase] for report in reports):>8.3f}")
+    print("Modules (construct / warm up)")
+    for module in reports[0]["modules"]:
+        construct = statistics.median(report["modules"][module].get("construct", 0) for report in reports)
+        warm_up = statistics.median(report["modules"][module].get("warm_up", 0) for report in reports)
+        print(f"  {module:<28}{construct:>8.3f}{warm_up:>8.3f}")
+    print("Slowest imports")
+    imports = {name: statistics.median(report["imports"].get(name, 0) for report in reports)
+               for name in reports[0]["imports"]}
+    for name, seconds in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print(f"  {name:<56}{seconds:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Closed loop simulation benchmark for the environment controller
+
+Runs the real EnvironmentController and ControlledDevice logic against a simple thermal model of the room on
+virtual time, with fake heaters/coolers and a fake temperature sensor, and reports how well the setpoint is held.
+Use it to compare hysteresis (lower/upper delta), dwell time and evaluation cadence settings offline.
+Run from the repository root:
+    python Benchmarks/environment_sim.py --hours 12 --lower -1 --upper 1
+    python Benchmarks/environment_sim.py --poll-interval 30  # Evaluate on a fixed interval like the old loop
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class VirtualClock:
+
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+
+class ThermalModel:
+    """
+    A single zone room, the temperature decays towards the outside temperature and every running device adds its rate
+    The sensor sees the room through a first order lag so the controller reacts late like a real sensor would
+    """
+
+    def __init__(self, start, outside, time_constant, sensor_lag):
+        self.temperature = start
+        self.sensed = start
+        self.outside = outside
+        self.time_constant = time_constant
+        self.sensor_lag = sensor_lag
+
+    def step(self, seconds, rate):
+        """
+        :param seconds: The length of the step
+        :param rate: The combined rate of every running device in degrees per second
+        """
+        self.temperature += ((self.outside - self.temperature) / self.time_constant + rate) * seconds
+        self.sensed += (self.temperature - self.sensed) * min(1.0, seconds / self.sensor_lag)
+
+
+def build_room(args, clock):
+    # Modules are discovered relative to the working directory
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    from loguru import logger as logging
+    logging.remove()
+    logging.add(sys.stderr, level="WARNING")
+
+    from ConcurrentDatabase.Database import Database
+    from Modules.RoomObject import RoomObject
+    from Modules.RoomControl.AbstractSmartDevices import AbstractToggleDevice
+    from Modules.RoomControl.EnvironmentController import (ControlledDevice, EnvironmentController,
+                                                           EnvironmentControllerHost)
+
+    class SimToggle(AbstractToggleDevice):
+        is_satellite = False
+
+        def __init__(self, name, rate):
+            super().__init__()
+            self.device_name = name
+            self.rate = rate  # Degrees per second while running
+            self.online = True
+            self.fault = False
+            self.running = False
+            self.cycles = 0
+            self.run_time = 0.0
+
+        def name(self):
+            return self.device_name
+
+        def is_on(self):
+            return self.running
+
+        def set_on(self, on: bool):
+            if on and not self.running:
+                self.cycles += 1
+            self.running = on
+
+    class SimSensor(RoomObject):
+        is_promise = False
+        is_sensor_only = True
+
+        def get_health(self):
+            return {"online": True, "fault": False, "reason": ""}
+
+    class SimRoomController:
+        def __init__(self, database):
+            self.database = database
+            self.objects = {}
+
+        def attach_module(self, module):
+            pass
+
+        def attach_object(self, device):
+            self.objects[device.name()] = device
+
+        def get_object(self, device_name, create_if_not_found=True):
+            return self.objects.get(device_name)
+
+    ControlledDevice.clock = staticmethod(clock.now)
+    ControlledDevice.min_dwell = args.min_dwell
+
+    database = Database(os.path.join(tempfile.mkdtemp(prefix="room_control_bench_"), "room_data.db"))
+    room_controller = SimRoomController(database)
+    EnvironmentControllerHost.database_init(room_controller)
+
+    sensor = SimSensor("SimSensor", "sim_sensor")
+    sensor.set_value("temperature", args.start)
+    room_controller.attach_object(sensor)
+
+    devices = [SimToggle("SimHeater", args.heater_rate / 3600)]
+    database.run("INSERT INTO enviv_control_devices (device_id, lower_delta, upper_delta, action_direction, "
+                 "control_source) VALUES (?, ?, ?, ?, ?)", ("SimHeater", args.lower, args.upper, 1, "SimController"))
+    if args.cooler:
+        devices.append(SimToggle("SimCooler", -args.cooler_rate / 3600))
+        database.run("INSERT INTO enviv_control_devices (device_id, lower_delta, upper_delta, action_direction, "
+                     "control_source) VALUES (?, ?, ?, ?, ?)",
+                     ("SimCooler", args.cooler_lower, args.cooler_upper, 2, "SimController"))
+    for device in devices:
+        room_controller.attach_object(device)
+    database.run("INSERT INTO enviv_controllers (name, current_set_point, source_name, enabled) VALUES (?, ?, ?, ?)",
+                 ("SimController", args.setpoint, "SimSensor;temperature", 1))
+
+    controller = EnvironmentController("SimController", room_controller)
+    return controller, sensor, devices
+
+
+def simulate(args):
+    random.seed(args.seed)
+    clock = VirtualClock()
+    controller, sensor, devices = build_room(args, clock)
+    # Sensor values are stored without emitting so every evaluation below happens synchronously on virtual time
+    # (setting them through set_value would evaluate on the event executor in real time)
+    model = ThermalModel(args.start, args.outside, args.time_constant * 3600, args.sensor_lag)
+
+    duration = args.hours * 3600
+    next_reading = 0.0
+    next_poll = 0.0
+    reached = None
+    above = below = 0.0
+    error_total = 0.0
+    error_samples = 0
+    while clock.time < duration:
+        if clock.time >= next_reading:
+            reading = round(model.sensed + random.gauss(0, args.sensor_noise), 1)
+            changed = reading != sensor.get_value("temperature")
+            sensor._values["temperature"] = reading
+            next_reading += args.sensor_interval
+            if args.poll_interval == 0 and changed:
+                controller.evaluate()  # Event driven, evaluated whenever the reading changes
+        if args.poll_interval and clock.time >= next_poll:
+            controller.evaluate()
+            next_poll += args.poll_interval
+
+        rate = sum(device.rate for device in devices if device.running)
+        for device in devices:
+            if device.running:
+                device.run_time += args.step
+        model.step(args.step, rate)
+        clock.time += args.step
+
+        error = model.temperature - args.setpoint
+        if reached is None and abs(error) <= args.tolerance:
+            reached = clock.time
+        if reached is not None:
+            above = max(above, error)
+            below = min(below, error)
+            error_total += abs(error)
+            error_samples += 1
+
+    hours = duration / 3600
+    mode = f"poll every {args.poll_interval}s" if args.poll_interval else "on sensor change"
+    print(f"Simulated {args.hours}h, setpoint {args.setpoint}, start {args.start}, outside {args.outside}, "
+          f"evaluated {mode}, sensor every {args.sensor_interval}s, dwell {args.min_dwell}s")
+    if reached is None:
+        print(f"  setpoint never reached (within {args.tolerance}), final temperature {model.temperature:.2f}")
+        return
+    print(f"  time to setpoint     {reached / 60:8.1f} min")
+    print(f"  overshoot            {above:8.2f}")
+    print(f"  undershoot           {-below:8.2f}")
+    print(f"  mean abs error       {error_total / error_samples:8.2f}")
+    for device in devices:
+        print(f"  {device.name():<12} cycles/h {device.cycles / hours:6.2f}  duty {device.run_time / duration:6.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, default=12, help="Simulated duration")
+    parser.add_argument("--step", type=float, default=1, help="Simulation step in seconds")
+    parser.add_argument("--setpoint", type=float, default=70)
+    parser.add_argument("--start", type=float, default=62, help="Starting room temperature")
+    parser.add_argument("--outside", type=float, default=40, help="Outside temperature")
+    parser.add_argument("--time-constant", type=float, default=3, help="Room heat loss time constant in hours")
+    parser.add_argument("--heater-rate", type=float, default=30, help="Degrees per hour added by the heater")
+    parser.add_argument("--lower", type=float, default=-1, help="Heater lower_delta")
+    parser.add_argument("--upper", type=float, default=1, help="Heater upper_delta")
+    parser.add_argument("--cooler", action="store_true", help="Add a cooler to the room")
+    parser.add_argument("--cooler-rate", type=float, default=30, help="Degrees per hour removed by the cooler")
+    parser.add_argument("--cooler-lower", type=float, default=1, help="Cooler lower_delta")
+    parser.add_argument("--cooler-upper", type=float, default=3, help="Cooler upper_delta")
+    parser.add_argument("--min-dwell", type=float, default=120, help="ControlledDevice minimum dwell in seconds")
+    parser.add_argument("--sensor-interval", type=float, default=10, help="Seconds between sensor readings")
+    parser.add_argument("--sensor-lag", type=float, default=60, help="Sensor time constant in seconds")
+    parser.add_argument("--sensor-noise", type=float, default=0.05, help="Standard deviation of sensor noise")
+    parser.add_argument("--poll-interval", type=float, default=0,
+                        help="Evaluate every N seconds instead of on every sensor change (0 = on change)")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="How close counts as reaching the setpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    simulate(args)
+    os._exit(0)  # Don't wait on the dwell timers
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Motion to light latency benchmark for the light controller
+
+Builds an OccupancyDetector and a LightController against a temporary database with a fake light and fake online
+BlueStalkers, then repeatedly emits a motion event and measures how long it takes for the light to be switched on and for the controller to confirm the change.
+Run from the repository root:
+    python Benchmarks/motion_latency.py --trials 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_room(db_path):
+    # Modules are discovered relative to the working directory
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    from loguru import logger as logging
+    logging.remove()
+    logging.add(sys.stderr, level="WARNING")
+
+    from ConcurrentDatabase.Database import Database
+    from Modules.RoomObject import RoomObject
+    from Modules.RoomControl.LightController import LightController, LightControllerHost
+    from Modules.RoomControl.OccupancyDetection.OccupancyDetector import OccupancyDetector
+
+    class BenchLight(RoomObject):
+        is_promise = False
+
+        def __init__(self, name):
+            super().__init__(name, "BenchLight")
+            self.is_auto = True
+            self._on = False
+            self.switched_on = threading.Event()
+            self.switched_on_at = None
+
+        @property
+        def on(self):
+            return self._on
+
+        @on.setter
+        def on(self, value):
+            self._on = value
+            if value:
+                self.switched_on_at = time.perf_counter()
+                self.switched_on.set()
+
+    class BenchStalker(RoomObject):
+        is_promise = False
+
+        def get_health(self):
+            return {"online": True, "fault": False, "reason": ""}
+
+    class BenchRoomController:
+        def __init__(self, database):
+            self.database = database
+            self.objects = {}
+            self.modules = []
+
+        def attach_module(self, module):
+            self.modules.append(module)
+
+        def get_module(self, module_name):
+            for module in self.modules:
+                if module.__class__.__name__ == module_name:
+                    return module
+            return None
+
+        def attach_object(self, device):
+            self.objects[device.object_name] = device
+
+        def get_object(self, device_name, create_if_not_found=True):
+            if device_name not in self.objects and create_if_not_found:
+                self.objects[device_name] = RoomObject(device_name, "promise")
+            return self.objects.get(device_name)
+
+    database = Database(db_path)
+    room_controller = BenchRoomController(database)
+    light = BenchLight("BenchLight")
+    room_controller.attach_object(light)
+    for name in ("BlueStalker", "BlueStalker2"):
+        room_controller.attach_object(BenchStalker(name, "BenchStalker"))
+        room_controller.objects[name].set_value("occupants", {})
+
+    LightControllerHost.database_init(room_controller)
+    database.run("INSERT INTO light_controllers (name, active_state, inactive_state, enabled, current_state) "
+                 "VALUES (?, ?, ?, ?, ?)", ("BenchController", '{"on": true}', '{"on": false}', 1, 0))
+    database.run("INSERT INTO light_control_devices (device_id, control_source) VALUES (?, ?)",
+                 ("BenchLight", "BenchController"))
+
+    occupancy_detector = OccupancyDetector(room_controller)
+    controller = LightController("BenchController", room_controller)
+    return room_controller, occupancy_detector, controller, light
+
+
+def wait_for_idle(controller, timeout=30):
+    deadline = time.time() + timeout
+    while controller.changing_state and time.time() < deadline:
+        time.sleep(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=5, help="Number of motion events to measure")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for the light on each trial")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="room_control_bench_"), "room_data.db")
+    room_controller, occupancy_detector, controller, light = build_room(db_path)
+    from Modules.RoomControl.LightController import LightControllerHost, StateEnumerator
+    motion_detector = room_controller.get_object("MotionDetector")
+
+    latencies = []
+    transitions = []
+    for trial in range(args.trials):
+        wait_for_idle(controller)
+        occupancy_detector.last_activity = 0
+        controller.current_state = StateEnumerator.inactive
+        light.switched_on.clear()
+
+        emitted = time.perf_counter()
+        motion_detector.emit_event("motion_detected", True)
+        if not light.switched_on.wait(args.timeout):
+            sys.exit(f"Trial {trial + 1}: the light was not switched on within {args.timeout} seconds")
+        latencies.append((light.switched_on_at - emitted) * 1000)
+        wait_for_idle(controller)
+        transitions.append((time.perf_counter() - emitted) * 1000)
+
+    print(f"Motion to light latency over {len(latencies)} trials (ms)")
+    print(f"  median {statistics.median(latencies):8.3f}")
+    print(f"  max    {max(latencies):8.3f}")
+    print(f"  min    {min(latencies):8.3f}")
+    print("Motion to confirmed state change (ms)")
+    print(f"  median {statistics.median(transitions):8.3f}")
+    print(f"  max    {max(transitions):8.3f}")
+    print(f"Safety sweep interval {LightControllerHost.sweep_interval}s")
+    os._exit(0)  # Don't wait on the background threads
+
+
+if __name__ == "__main__":
+    main()
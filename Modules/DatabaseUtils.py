@@ -0,0 +1,28 @@
+import sqlite3
+
+
+def run_batch(database, sql, rows):
+    """
+    Run a statement once for every row as a single transaction
+    Unlike Database.run_many the database lock is always released and a failed batch is rolled back, so either every
+    row is written or none of them are
+    :param database: The ConcurrentDatabase to write to
+    :param sql: The statement to run
+    :param rows: The parameters for each run of the statement
+    :raises sqlite3.Error: If the batch failed, in which case nothing was written
+    """
+    if not database.open:
+        raise RuntimeError("Database is not open")
+    database.lock.acquire()
+    try:
+        cursor = database.cursor()
+        try:
+            cursor.executemany(sql, rows)
+            database.commit()
+        except sqlite3.Error:
+            database.rollback()
+            raise
+        finally:
+            cursor.close()
+    finally:
+        database.lock.release()
@@ -0,0 +1,61 @@
+import threading
+
+from loguru import logger as logging
+
+
+class Subscription:
+    """Returned by EventBus.subscribe, pass it to unsubscribe to stop receiving the event"""
+
+    __slots__ = ("key", "callback")
+
+    def __init__(self, key, callback):
+        self.key = key
+        self.callback = callback
+
+
+class EventBus:
+    """
+    Delivers the events emitted by every RoomObject to subscribers that aren't attached to the object directly
+    Subscribers are indexed by (object_name, event_name) so publishing an event only touches the subscribers of that
+    event, the subscriber lists are replaced rather than modified so publishing never takes the lock
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._subscribers = {}  # type: dict[tuple[str, str], tuple[Subscription, ...]]
+
+    def subscribe(self, object_name, event_name, callback):
+        """
+        Subscribe to an event emitted by a room object
+        :param object_name: The name of the object that emits the event
+        :param event_name: The name of the event (e.g. "on_occupied_update")
+        :param callback: Called with the event's arguments on the thread that emitted the event
+        :return: The Subscription to pass to unsubscribe
+        """
+        subscription = Subscription((object_name, event_name), callback)
+        with self.lock:
+            self._subscribers[subscription.key] = self._subscribers.get(subscription.key, ()) + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            remaining = tuple(sub for sub in self._subscribers.get(subscription.key, ()) if sub is not subscription)
+            if remaining:
+                self._subscribers[subscription.key] = remaining
+            else:
+                self._subscribers.pop(subscription.key, None)
+
+    def has_subscribers(self, object_name, event_name):
+        return (object_name, event_name) in self._subscribers
+
+    def publish(self, object_name, event_name, *args, **kwargs):
+        """Call every subscriber of the event, a failing subscriber doesn't stop the others from being called"""
+        for subscription in self._subscribers.get((object_name, event_name), ()):
+            try:
+                subscription.callback(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"EventBus: Error in subscriber to {object_name}.{event_name}: {e}")
+                logging.exception(e)
+
+
+event_bus = EventBus()
@@ -26,5 +26,8 @@ class NameHandler:
         else:
             logging.info(f"Updating {object_id} name from {current_name} to {name}")
             self.database.run("UPDATE name_relations SET name = ? WHERE object_id = ?", (name, object_id))
+        scene_controller = self.room_controller.get_module("SceneController")
+        if scene_controller is not None:
+            scene_controller.invalidate_summaries()  # Scene summaries describe the devices they act on
 
 
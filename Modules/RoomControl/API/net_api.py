@@ -22,6 +22,7 @@ from Modules.RoomControl.Decorators import background
 from loguru import logger as logging
 
 from Modules.RoomModule import RoomModule
+from Modules.StartupProfiler import startup_profiler
 
 
 def login_redirect():
@@ -114,6 +115,9 @@ class NetAPI(RoomModule):
             + [web.post('/scene_action/{action}/{scene_id}', self.handle_scene_command)]
             + [web.get('/run_command/{name}', self.handle_run_command)]
             + [web.get('/sys_info', self.handle_sys_info)]
+            + [web.get('/startup_report', self.handle_startup_report)]
+            + [web.get('/backup/status', self.handle_backup_status)]
+            + [web.post('/backup/run', self.handle_backup_run)]
             + [web.get('/get_system_monitors', self.handle_system_monitors)]
             + [web.get('/db_write', self.db_writer)]  # Allows you to write to the database
             + [web.post('/set/{name}', self.handle_set_post)]
@@ -549,6 +553,11 @@ class NetAPI(RoomModule):
         else:
             value = request.match_info['value']
             target = request.match_info['target']
+            if value == "scenes":  # The scene list is cached already serialized
+                # Rebuilding it waits on the scene lock, so it's kept off the event loop
+                body = await asyncio.get_running_loop().run_in_executor(
+                    None, self.room_controller.get_module("SceneController").get_scenes_payload)
+                return web.Response(body=body, content_type="text/plain", charset="utf-8")
             msg = APIMessageTX(result=self.room_controller.get_module("SceneController").execute_get(value, target))
 
         return web.Response(text=msg.__str__())
@@ -591,6 +600,36 @@ class NetAPI(RoomModule):
 
         return web.Response(text=generate_sys_info().__str__())
 
+    async def handle_startup_report(self, request):
+        if not self.check_auth(request):
+            raise web.HTTPUnauthorized()
+        logging.debug("Received STARTUP_REPORT request")
+
+        return web.Response(text=APIMessageTX(startup=startup_profiler.report()).__str__())
+
+    async def handle_backup_status(self, request):
+        if not self.check_auth(request):
+            raise web.HTTPUnauthorized()
+        logging.debug("Received BACKUP_STATUS request")
+
+        if self.room_controller.get_module("DatabaseBackup") is None:
+            msg = APIMessageTX(error="Backup module not found")
+        else:
+            msg = APIMessageTX(backup=self.room_controller.get_module("DatabaseBackup").get_status())
+        return web.Response(text=msg.__str__())
+
+    async def handle_backup_run(self, request):
+        if not self.check_auth(request):
+            raise web.HTTPUnauthorized()
+        logging.info("Received BACKUP_RUN request")
+
+        if self.room_controller.get_module("DatabaseBackup") is None:
+            msg = APIMessageTX(error="Backup module not found")
+        else:
+            self.room_controller.get_module("DatabaseBackup").request_backup()
+            msg = APIMessageTX(result="started")
+        return web.Response(text=msg.__str__())
+
     async def handle_name(self, request):
         if not self.check_auth(request):
             raise web.HTTPUnauthorized()
@@ -648,17 +687,21 @@ class NetAPI(RoomModule):
         # logging.info("Received WEATHER_FORECAST_LIST request")
         if self.room_controller.get_module("WeatherRelay") is None:
             return web.Response(text="Weather module not found", status=503)
-        data = self.room_controller.get_module("WeatherRelay").get_available_forecast()
-        msg = APIMessageTX(weather_forecast_list=data)
-        return web.Response(text=msg.__str__())
+        data = self.room_controller.get_module("WeatherRelay").get_available_forecast_payload()
+        if data is None:
+            return web.Response(text="Forecast data not found", status=503)
+        return web.Response(body=data, content_type="text/plain", charset="utf-8")
 
     async def handle_weather_forecast(self, request):
         # if not self.check_auth(request):
         #     raise web.HTTPUnauthorized()
         # logging.info("Received WEATHER_FORECAST request")
-        data = self.room_controller.get_module("WeatherRelay").get_forecast(request.match_info['time'])
-        msg = APIMessageTX(weather_forecast=data.to_dict())
-        return web.Response(text=msg.__str__())
+        if self.room_controller.get_module("WeatherRelay") is None:
+            return web.Response(text="Weather module not found", status=503)
+        data = self.room_controller.get_module("WeatherRelay").get_forecast_payload(request.match_info['time'])
+        if data is None:
+            return web.Response(text="Forecast not found", status=404)
+        return web.Response(body=data, content_type="text/plain", charset="utf-8")
 
     async def handle_weather_past(self, request):
         # if not self.check_auth(request):
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger as logging
+
+from Modules.RoomControl.Decorators import background
+from Modules.RoomModule import RoomModule
+
+
+class DatabaseBackup(RoomModule):
+    """
+    Periodically snapshots the room database using SQLite's online backup API
+    The backup copies a small number of pages per step and sleeps between steps so it never stalls the other users
+    of the database or saturates the SD card, the newest snapshot is {db_path}.bak followed by {db_path}.bak.1, etc.
+    """
+
+    startup_delay = 60  # Don't compete with startup for I/O, kept short so frequent restarts still get backups
+    backup_interval = 60 * 60 * 24
+    retry_delay = 60 * 60  # Wait before trying again after a failed backup
+    pages_per_step = 256
+    step_delay = 0.05  # Seconds to sleep between steps
+    snapshots_kept = 3
+
+    def __init__(self, room_controller):
+        super().__init__(room_controller)
+        self.database = room_controller.database
+        self.db_path = room_controller.db_path
+        self.backup_lock = threading.Lock()
+        self.status = {
+            "state": "idle",
+            "remaining": None,
+            "total": None,
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        self.backup_scheduler()
+
+    @background
+    def backup_scheduler(self):
+        """
+        Backups are scheduled from the age of the newest snapshot rather than from boot, so restarting the room
+        controller doesn't push the next backup back, a backup is taken soon after boot if the newest one is overdue
+        """
+        time.sleep(self.startup_delay)
+        while True:
+            delay = self._next_backup_delay()
+            if delay > 0:
+                time.sleep(delay)
+                continue  # Checked again in case a backup was requested in the meantime
+            if not self.run_backup():  # A requested backup is already running
+                time.sleep(self.startup_delay)
+            elif self.status["state"] == "failed":
+                time.sleep(self.retry_delay)
+
+    def _next_backup_delay(self):
+        """Seconds until the next backup is due based on the newest snapshot, 0 if there is no snapshot yet"""
+        try:
+            newest = os.path.getmtime(self._snapshot_path(0))
+        except OSError:
+            return 0
+        return max(0.0, newest + self.backup_interval - time.time())
+
+    def run_backup(self):
+        """
+        Take a new snapshot of the database and rotate the old ones
+        :return: False if a backup was already running
+        """
+        if not self.backup_lock.acquire(blocking=False):
+            logging.warning("DatabaseBackup: Backup already in progress")
+            return False
+        temp_path = f"{self.db_path}.bak.tmp"
+        try:
+            logging.info("DatabaseBackup: Starting backup")
+            self.status.update(state="running", remaining=None, total=None, started=time.time(), error=None)
+            target = sqlite3.connect(temp_path)
+            try:
+                # backup's own sleep argument only applies when a step hits a busy or locked database, the pause
+                # between ordinary steps is taken in _progress
+                self.database.backup(target, pages=self.pages_per_step, progress=self._progress)
+            finally:
+                target.close()
+            self._rotate_snapshots(temp_path)
+            self.status.update(state="idle", finished=time.time())
+            logging.info(f"DatabaseBackup: Backup complete, {self.status['total']} pages backed up in "
+                         f"{self.status['finished'] - self.status['started']:.1f} seconds")
+        except (sqlite3.Error, OSError) as e:
+            logging.error(f"DatabaseBackup: Backup failed: {e}")
+            self.status.update(state="failed", error=str(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            self.backup_lock.release()
+        return True
+
+    def _progress(self, status, remaining, total):
+        self.status.update(remaining=remaining, total=total)
+        if remaining > 0:
+            time.sleep(self.step_delay)  # Called after every step, gives the other users of the database a turn
+
+    def _snapshot_path(self, index):
+        return f"{self.db_path}.bak" if index == 0 else f"{self.db_path}.bak.{index}"
+
+    def _rotate_snapshots(self, new_snapshot):
+        """Shift every snapshot back one place, dropping the oldest, and make the new snapshot the newest"""
+        for index in range(self.snapshots_kept - 1, 0, -1):
+            if os.path.exists(self._snapshot_path(index - 1)):
+                os.replace(self._snapshot_path(index - 1), self._snapshot_path(index))
+        os.replace(new_snapshot, self._snapshot_path(0))
+
+    def get_snapshots(self):
+        snapshots = []
+        for index in range(self.snapshots_kept):
+            path = self._snapshot_path(index)
+            if os.path.exists(path):
+                snapshots.append({"path": path, "size": os.path.getsize(path), "created": os.path.getmtime(path)})
+        return snapshots
+
+    def get_status(self):
+        status = dict(self.status)
+        if status["state"] == "running" and status["total"]:
+            status["percent"] = round(100 * (status["total"] - status["remaining"]) / status["total"], 1)
+        status["snapshots"] = self.get_snapshots()
+        return status
+
+    @background
+    def request_backup(self):
+        """Called by the API to take a snapshot now instead of waiting for the schedule"""
+        self.run_backup()
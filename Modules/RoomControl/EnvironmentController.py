@@ -1,3 +1,4 @@
+import threading
 import time
 from loguru import logger as logging
 
@@ -11,6 +12,7 @@ from Modules.RoomObject import RoomObject
 class EnvironmentControllerHost(RoomModule):
     search_name = "EnvironmentController"
     search_type = "environment_controller"
+    sweep_interval = 30  # Controllers react to sensor updates, this only catches anything an update didn't cover
 
     def __init__(self, room_controller):
         super().__init__(room_controller)
@@ -27,6 +29,7 @@ class EnvironmentControllerHost(RoomModule):
             self.enviv_controllers[controller['name']] = \
                 EnvironmentController(controller['name'], self.room_controller)
             self.room_controller.attach_object(self.enviv_controllers[controller['name']])
+        self.periodic_check()
 
     def database_init(self):
         # cursor = self.database.cursor()
@@ -55,6 +58,13 @@ class EnvironmentControllerHost(RoomModule):
         # cursor.close()
         # self.database.commit()
 
+    @background
+    def periodic_check(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            for controller in self.enviv_controllers.values():
+                controller.evaluate()
+
     def refresh_all(self):
         pass
 
@@ -83,6 +93,7 @@ class EnvironmentController(RoomObject):
 
         self.online = True
         self._reason = "Unknown"
+        self.evaluate_lock = threading.Lock()  # Sensor updates, setpoint changes and the sweep may evaluate at once
 
         table = self.database.get_table("enviv_controllers")
         self.controller_entry = table.get_row(name=self.controller_name)
@@ -103,56 +114,70 @@ class EnvironmentController(RoomObject):
                 ControlledDevice(device['device_id'], self.room_controller.get_object(device['device_id']),
                                  self.database, self))
 
-        self.on = self.enabled
+        if hasattr(self.source, "get_value") and hasattr(self.source, "get_health"):
+            # Sensor updates can arrive on the webserver's event loop, switching devices would block it
+            self.source.attach_event_callback(self._source_updated, f"on_{self.sub_source}_update",
+                                              dispatch="executor")
+            self.source.attach_event_callback(self._source_updated, "on_health_update", dispatch="executor")
 
-        self.periodic_check()
+        self.on = self.enabled
 
     def _update_devices_auto_state(self):
         for device in self.devices:
             if hasattr(device.device, "auto"):
                 device.device.auto = self.enabled
 
+    def _source_updated(self, *args):
+        self.evaluate()
+
     @background
-    def periodic_check(self):
-        if hasattr(self.source, "get_value") and hasattr(self.source, "get_health"):
-            while True:
-                self._update_devices_auto_state()
-                if self.enabled:
-                    if self.source.object_type == "promise":
-                        self._fault = True
-                        self._reason = "Source Is Promise"
-                        for device in self.devices:
-                            if not device.fault:
-                                device.fault = True
-                                device.fault_encountered()
-                    elif not self.source.get_health()["online"]:
-                        for device in self.devices:
-                            if not device.fault:
-                                device.fault = True
-                                device.fault_encountered()
-                        self._fault = True
-                        self._reason = "Source offline"
-                    elif self.source.get_health()["fault"]:
-                        self._fault = True
-                        self._reason = "Source faulted"
-                    elif len(self.devices) == 0:
-                        self._fault = True
-                        self._reason = "No devices assigned"
-                    elif self.all_controlled_devices_down():
-                        self._fault = True
-                        self._reason = "No working devices"
-                        for device in self.devices:
-                            device.fault = False
-                    else:
-                        for device in self.devices:
-                            device.fault_resolved()
-                            device.check(self.source.get_value(self.sub_source), self.current_setpoint)
-                        self._fault = False
-                        self._reason = "Unknown"
-                time.sleep(30)
-        else:
+    def request_evaluation(self):
+        """Evaluate in the background, used when a change comes from the API"""
+        self.evaluate()
+
+    def evaluate(self):
+        """
+        Check the source sensor and turn the controlled devices on or off, called whenever the sensor value or the
+        setpoint changes and periodically by the host as a safety sweep
+        """
+        if not (hasattr(self.source, "get_value") and hasattr(self.source, "get_health")):
             logging.warning(f"EnvironmentController ({self.controller_name}): Source sensor is not a sensor")
             self._reason = "Source is not a sensor"
+            return
+        with self.evaluate_lock:
+            self._update_devices_auto_state()
+            if self.enabled:
+                if self.source.object_type == "promise":
+                    self._fault = True
+                    self._reason = "Source Is Promise"
+                    for device in self.devices:
+                        if not device.fault:
+                            device.fault = True
+                            device.fault_encountered()
+                elif not self.source.get_health()["online"]:
+                    for device in self.devices:
+                        if not device.fault:
+                            device.fault = True
+                            device.fault_encountered()
+                    self._fault = True
+                    self._reason = "Source offline"
+                elif self.source.get_health()["fault"]:
+                    self._fault = True
+                    self._reason = "Source faulted"
+                elif len(self.devices) == 0:
+                    self._fault = True
+                    self._reason = "No devices assigned"
+                elif self.all_controlled_devices_down():
+                    self._fault = True
+                    self._reason = "No working devices"
+                    for device in self.devices:
+                        device.fault = False
+                else:
+                    for device in self.devices:
+                        device.fault_resolved()
+                        device.check(self.source.get_value(self.sub_source), self.current_setpoint)
+                    self._fault = False
+                    self._reason = "Unknown"
 
     def __str__(self):
         return f"EnvironmentController ({self.controller_name})"
@@ -241,6 +266,7 @@ class EnvironmentController(RoomObject):
         self.controller_entry.set(enabled=value)
 
         logging.info(f"EnvironmentController ({self.controller_name}): Enabled set to {value}")
+        self.request_evaluation()
 
     @property
     def setpoint(self):
@@ -256,6 +282,7 @@ class EnvironmentController(RoomObject):
         # self.database.commit()
 
         self.controller_entry.set(current_set_point=value)
+        self.request_evaluation()
 
     @property
     def target_value(self):
@@ -285,9 +312,12 @@ class EnvironmentController(RoomObject):
     def directionality(self, value):
         if value in [self.DirectionEnums.INCREASE, self.DirectionEnums.DECREASE, self.DirectionEnums.BOTH]:
             self._directionality = value
+            self.request_evaluation()
 
 
 class ControlledDevice:
+    min_dwell = 120  # Seconds a device has to stay on or off before it is switched again to protect relays
+    clock = staticmethod(time.monotonic)  # Replaced by the simulation benchmark to run on virtual time
 
     def __init__(self, name, device: AbstractToggleDevice, database: ConcurrentDatabase.Database, parent=None):
         self.name = name
@@ -303,6 +333,8 @@ class ControlledDevice:
         self.lower_hysteresis = float(device['lower_delta'])
         self.upper_hysteresis = float(device['upper_delta'])
         self.fault = False
+        self.last_switched = None  # type: float # clock() of the last switch made by check
+        self.dwell_timer = None  # type: threading.Timer # Re-evaluates the parent once the dwell has passed
 
     def increasing(self):
         return self.action_direction == 1 and self.device.on
@@ -310,6 +342,25 @@ class ControlledDevice:
     def decreasing(self):
         return self.action_direction != 1 and self.device.on
 
+    def _switch(self, state):
+        """
+        Switch the device unless it was switched less than min_dwell ago, in which case the parent (if there is one)
+        is evaluated again once the dwell has passed
+        """
+        now = self.clock()
+        if self.last_switched is not None and now - self.last_switched < self.min_dwell:
+            if self.parent is not None and (self.dwell_timer is None or not self.dwell_timer.is_alive()):
+                remaining = self.min_dwell - (now - self.last_switched)
+                logging.info(f"ControlledDevice ({self.name}): Holding state for {remaining:.0f} seconds")
+                self.dwell_timer = threading.Timer(remaining, self.parent.evaluate)
+                self.dwell_timer.daemon = True
+                self.dwell_timer.start()
+            return False
+        self.device.on = state
+        self.last_switched = now
+        logging.info(f"ControlledDevice ({self.name}): Turning {'on' if state else 'off'}")
+        return True
+
     def check(self, current_value, setpoint):
         """
         Checks if this particular device should be on or off
@@ -320,24 +371,20 @@ class ControlledDevice:
                 return
             if self.device.on:  # If the device is on check if it should be turned off
                 if current_value > setpoint + self.upper_hysteresis:  # If the current value is above the setpoint plus the upper hysteresis
-                    self.device.on = False
-                    logging.info(f"ControlledDevice ({self.name}): Turning off")
+                    self._switch(False)
             else:  # If the device is off check if it should be turned on
                 if current_value < setpoint + self.lower_hysteresis:  # If the current value is below the setpoint plus the lower hysteresis
-                    self.device.on = True
-                    logging.info(f"ControlledDevice ({self.name}): Turning on")
+                    self._switch(True)
         else:  # If the action direction is negative (the device causes the source to decrease)
             if not (self.parent.directionality == self.parent.DirectionEnums.BOTH or
                     self.parent.directionality == self.parent.DirectionEnums.DECREASE):
                 return
             if self.device.on:  # If the device is on check if it should be turned off
                 if current_value < setpoint + self.lower_hysteresis:  # If the current value is below the setpoint minus the upper hysteresis
-                    self.device.on = False
-                    logging.info(f"ControlledDevice ({self.name}): Turning off")
+                    self._switch(False)
             else:
                 if current_value > setpoint + self.upper_hysteresis:
-                    self.device.on = True
-                    logging.info(f"ControlledDevice ({self.name}): Turning on")
+                    self._switch(True)
 
     def fault_encountered(self):
         """
@@ -18,17 +18,22 @@ class GoveeAPI(RoomModule):
         super().__init__(room_controller)
         self.database = room_controller.database
 
+        self.api_key = None
+        self.devices = []
+
         secrets = self.database.get_table("secrets")
         try:
             self.api_key = secrets.get_row(secret_name="govee_key")["secret_value"]
         except Exception as e:
             logging.error("Govee API key not found in secrets table")
+
+    def warm_up(self):
+        if self.api_key is None:
             return
-        self.devices = []
         devices_payload = self.request_devices()
         for device in devices_payload["data"]:
             logging.info(f"Creating device {device['deviceName']} [{device['device']}]")
-            self.devices.append(GoveeDevice(room_controller, self.api_key, device["sku"], device["device"]))
+            self.devices.append(GoveeDevice(self.room_controller, self.api_key, device["sku"], device["device"]))
 
     def request_devices(self):
         url = f"{api_endpoint}/router/api/v1/user/devices"
@@ -1,4 +1,7 @@
+import asyncio
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import ConcurrentDatabase
 from Modules.RoomControl.API.action_handler import process_device_command
@@ -7,11 +10,17 @@ from Modules.RoomControl.Decorators import background
 from Modules.RoomControl.OccupancyDetection.BluetoothOccupancy import BluetoothDetector
 
 from loguru import logger as logging
+
+from Modules.EventBus import event_bus
 from Modules.RoomControl.OccupancyDetection.OccupancyDetector import OccupancyDetector
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
 
 
+# Device writes and readbacks may block on network I/O so they are run here, letting every device change at once
+device_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="LightControllerDevices")
+
+
 class StateEnumerator:
     inactive = 0
     active = 1
@@ -21,6 +30,7 @@ class StateEnumerator:
 
 
 class LightControllerHost(RoomModule):
+    sweep_interval = 30  # Controllers react to occupancy events, this only catches anything an event didn't cover
 
     def __init__(self, room_controller):
         super().__init__(room_controller)
@@ -63,7 +73,7 @@ class LightControllerHost(RoomModule):
         while True:
             for controller in self.light_controllers.values():
                 controller.update_state()
-            time.sleep(2.5)
+            time.sleep(self.sweep_interval)
 
     def refresh_all(self):
         pass
@@ -71,6 +81,12 @@ class LightControllerHost(RoomModule):
 
 class LightController(RoomObject):
     is_promise = False
+    max_attempts = 3  # Failed transitions to the same state before giving up until the target state changes
+    verify_timeout = 5  # Seconds to wait for every device to confirm a state change
+    verify_initial_delay = 0.1  # First readback delay, doubled after every readback that isn't fully confirmed
+    verify_max_delay = 1
+    retry_initial_delay = 2  # Seconds before retrying a failed transition, doubled after every failed attempt
+    retry_max_delay = 30
 
     def __init__(self, name, room_controller):
         super().__init__(name, "LightController")
@@ -103,7 +119,11 @@ class LightController(RoomObject):
 
         self.online = True
         self.changing_state = False
+        self.pending_update = False  # An occupancy event arrived while the state was changing
+        self.state_lock = threading.Lock()
         self.attempts = 0
+        self.attempt_target = None  # The state the attempts are counting failures to reach
+        self.retry_timer = None  # type: threading.Timer  # Retries a failed transition once its backoff has passed
         self.dnd_active = True if self.current_state == StateEnumerator.dnd else False
 
         self.occupancy_detector = self.room_controller.get_module("OccupancyDetector")  # type: OccupancyDetector
@@ -123,6 +143,9 @@ class LightController(RoomObject):
         for target in targets:
             self.light_control_targets.append(target['device_uuid'])
 
+        self.subscriptions = [event_bus.subscribe(OccupancyDetector.event_source, event, self._occupancy_event)
+                              for event in OccupancyDetector.events]
+
         self.on = self.enabled
         logging.info(f"LightController: {name} has been initialised,"
                      f" {len(self.light_control_devices)} devices and {len(self.light_control_targets)} targets")
@@ -154,88 +177,160 @@ class LightController(RoomObject):
                 return True
         return False
 
+    def _occupancy_event(self, *args, **kwargs):
+        self.update_state()
+
+    def _next_state(self):
+        """
+        Work out which state the lights should be in
+        :return: The state value and the state to apply, or None if the lights should stay as they are
+        """
+        if self.dnd_active:
+            if self.dnd_state is not None:
+                return StateEnumerator.dnd, self.dnd_state
+        target = None
+        bluetooth_offline = self.occupancy_detector.bluetooth_offline()
+        activity_recent = self.occupancy_detector.was_activity_recent()
+        # If the state isn't already on or motion
+        if self.current_state != StateEnumerator.active and self.current_state != StateEnumerator.motion:
+            if bluetooth_offline:  # If the bluetooth detector has faulted
+                if self.fault_state is not None:  # If there is a fault state to go to
+                    target = StateEnumerator.fault, self.fault_state
+        # If the state is off or faulted
+        if self.current_state == StateEnumerator.inactive or self.current_state == StateEnumerator.fault:
+            if activity_recent:  # If there was activity in the room recently
+                target = StateEnumerator.motion, self.active_state
+        if not bluetooth_offline:
+            if self._check_occupancy():
+                target = StateEnumerator.active, self.active_state
+            elif not activity_recent:
+                target = StateEnumerator.inactive, self.inactive_state
+        return target
+
     def update_state(self):
-        if self.enabled and not self.changing_state:
-            if self.dnd_active:
-                if self.dnd_state is not None:
-                    self.set_state(StateEnumerator.dnd, self.dnd_state)
-                    return
-            # If the state isn't already on or motion
-            if self.current_state != StateEnumerator.active and self.current_state != StateEnumerator.motion:
-                if self.occupancy_detector.bluetooth_offline():  # If the bluetooth detector has faulted
-                    if self.fault_state is not None:  # If there is a fault state to go to
-                        self.set_state(StateEnumerator.fault, self.fault_state)  # Set the state to fault
-            # If the state is off or faulted
-            if self.current_state == StateEnumerator.inactive or self.current_state == StateEnumerator.fault:
-                if self.occupancy_detector.was_activity_recent():  # If there was activity in the room recently
-                    self.set_state(StateEnumerator.motion, self.active_state)
-            if not self.occupancy_detector.bluetooth_offline():  # If the bluetooth detector has faulted
-                if self._check_occupancy():
-                    self.set_state(StateEnumerator.active, self.active_state)
-                elif not self.occupancy_detector.was_activity_recent():
-                    self.set_state(StateEnumerator.inactive, self.inactive_state)
-        elif self.changing_state:
-            logging.info(f"LightController: {self.controller_name} is changing state")
+        """Re-evaluate the state, called on every occupancy event and periodically by the host as a safety sweep"""
+        with self.state_lock:
+            if not self.enabled:
+                return
+            if self.changing_state:
+                # Evaluated again once the change finishes so the event isn't lost
+                self.pending_update = True
+                return
+            target = self._next_state()
+            if target is None or target[0] == self.current_state:
+                return
+            if target[0] == self.attempt_target:
+                if self.retry_timer is not None:
+                    return  # Still backing off from a failed attempt at this state, the timer will retry it
+                if self.attempts >= self.max_attempts:
+                    return  # Given up on this state, only a different target state tries again
+            self.changing_state = True
+        self.set_state(*target)
 
     @background
     def set_state(self, state_val, state=None):
         prev_state = self.current_state
-        if self.attempts > 3:
-            return
+        retry = False
         try:
+            if state_val != self.attempt_target:  # Failures only count against the state that failed
+                self.attempt_target = state_val
+                self.attempts = 0
+            if self.attempts >= self.max_attempts:
+                logging.debug(f"LightController: {self.controller_name} has given up changing state to {state_val}")
+                return
             if self.current_state != state_val:
                 self.changing_state = True
                 self.current_state = state_val
                 logging.info(f"LightController: {self.controller_name} is changing state to {state_val}")
-                # Use the API action_handler method to process the state change
-                for device in self.light_control_devices.values():
-                    if device is None:
-                        raise ValueError(f"Device ({device}) not found")
-                    else:  # Device found
-                        for key, value in state.__dict__.items():  # Loop through all attributes in the message
-                            if hasattr(device, key):  # Check the device has an attribute with the same name
-                                setattr(device, key, value)
-                            else:
-                                logging.error(f"LightController: {self.controller_name} failed to change {device} "
-                                              f"state to {state_val}")
-                time.sleep(5)
-                logging.info(f"Validating state change for {self.controller_name}")
-                # Validate the state change
-                for device in self.light_control_devices.values():
-                    if device is None:
-                        raise ValueError(f"Device ({device}) not found")
-                    else:
-                        for key, value in state.__dict__.items():
-                            if hasattr(device, key):
-                                if isinstance(getattr(device, key), tuple):
-                                    # If the attribute is a tuple then cast it to a list for comparison
-                                    if list(getattr(device, key)) != list(value):
-                                        logging.error(f"LightController: {self.controller_name} failed to change "
-                                                      f"state to {state_val}")
-                                        logging.error(f"LightController: {self.controller_name} failed to change {key}"
-                                                      f" to {value} current value is "
-                                                      f"{getattr(device, key)}")
-                                        self.current_state = prev_state
-                                        self.attempts += 1
-                                elif getattr(device, key) != value:
-                                    logging.error(f"LightController: {self.controller_name} failed to change state"
-                                                  f" to {state_val}")
-                                    logging.error(f"LightController: {self.controller_name} failed to change {key} "
-                                                  f"to {value} current value is "
-                                                  f"{getattr(device, key)}")
-                                    self.attempts += 1
-                                    self.current_state = prev_state
+                started = time.perf_counter()
+                if asyncio.run(self._apply_state(state)):
+                    self.attempts = 0
+                    logging.info(f"LightController: {self.controller_name} changed state to {state_val} in "
+                                 f"{time.perf_counter() - started:.2f} seconds")
+                else:
+                    self.attempts += 1
+                    self.current_state = prev_state
+                    retry = self.attempts < self.max_attempts
+                    logging.error(f"LightController: {self.controller_name} failed to change state to {state_val} "
+                                  f"(attempt {self.attempts} of {self.max_attempts})")
         except Exception as e:
             logging.error(f"LightController: {self.controller_name} failed to change state to {state_val} due to {e}")
             self.current_state = prev_state
         finally:
-            self.changing_state = False
-            self.attempts = 0
             try:
                 # Update current state in the database
                 self.controller.set(current_state=self.current_state)
             except Exception as e:
                 logging.error(f"LightController: {self.controller_name} failed to update database due to {e}")
+            with self.state_lock:
+                self.changing_state = False
+                pending, self.pending_update = self.pending_update, False
+                if retry and self.retry_timer is None:
+                    # Spaced out so the attempts don't all land inside the same device hiccup
+                    delay = min(self.retry_initial_delay * 2 ** (self.attempts - 1), self.retry_max_delay)
+                    self.retry_timer = threading.Timer(delay, self._retry)
+                    self.retry_timer.daemon = True
+                    self.retry_timer.start()
+            if pending:
+                self.update_state()
+
+    def _retry(self):
+        with self.state_lock:
+            self.retry_timer = None
+        self.update_state()
+
+    async def _apply_state(self, state):
+        """
+        Write the state to every device concurrently then read it back until every device confirms it
+        :return: True if every device confirmed the state before verify_timeout
+        """
+        loop = asyncio.get_running_loop()
+        for name, device in self.light_control_devices.items():
+            if device is None:
+                raise ValueError(f"Device ({name}) not found")
+        values = state.__dict__.items()
+        await asyncio.gather(*(loop.run_in_executor(device_executor, self._write_device, device, values)
+                               for device in self.light_control_devices.values()))
+        pending = dict(self.light_control_devices)
+        delay = self.verify_initial_delay
+        deadline = loop.time() + self.verify_timeout
+        while True:
+            await asyncio.sleep(delay)
+            names = list(pending.keys())
+            confirmed = await asyncio.gather(*(loop.run_in_executor(device_executor, self._device_matches,
+                                                                    pending[name], values) for name in names))
+            for name, matches in zip(names, confirmed):
+                if matches:
+                    del pending[name]
+            if not pending:
+                return True
+            if loop.time() + delay > deadline:
+                break
+            delay = min(delay * 2, self.verify_max_delay)
+        for name, device in pending.items():
+            for key, value in values:
+                if hasattr(device, key) and not self._value_matches(getattr(device, key), value):
+                    logging.error(f"LightController: {self.controller_name} failed to change {key} on {name} to "
+                                  f"{value} current value is {getattr(device, key)}")
+        return False
+
+    def _write_device(self, device, values):
+        for key, value in values:  # Loop through all attributes in the message
+            if hasattr(device, key):  # Check the device has an attribute with the same name
+                setattr(device, key, value)
+            else:
+                logging.error(f"LightController: {self.controller_name} failed to change {key} on {device} "
+                              f"as it does not have the attribute")
+
+    def _device_matches(self, device, values):
+        return all(self._value_matches(getattr(device, key), value) for key, value in values if hasattr(device, key))
+
+    @staticmethod
+    def _value_matches(current, value):
+        if isinstance(current, tuple):
+            # If the attribute is a tuple then cast it to a list for comparison
+            return list(current) == list(value)
+        return current == value
 
     def get_state(self):
         return {
@@ -282,9 +377,10 @@ class LightController(RoomObject):
 
     @on.setter
     def on(self, value):
-        self.enabled = value
-        self.changing_state = False
-        self.current_state = StateEnumerator.inactive
+        with self.state_lock:
+            self.enabled = value
+            self.changing_state = False
+            self.current_state = StateEnumerator.inactive
         table = self.database.get_table("light_controllers")
         row = table.get_row(name=self.controller_name)
         row.set(enabled=value)
@@ -294,6 +390,7 @@ class LightController(RoomObject):
                 device.is_auto = value
             else:
                 logging.warning(f"Device {device} does not have is_auto attribute")
+        self.update_state()
 
     @property
     def enable_dnd(self):
@@ -302,7 +399,7 @@ class LightController(RoomObject):
     @enable_dnd.setter
     def enable_dnd(self, value):
         self.dnd_active = value
-        self.update()
+        self.update_state()
 
     def set_on(self, value):
         self.on = value
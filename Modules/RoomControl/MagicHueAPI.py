@@ -35,18 +35,19 @@ class MagicHome(RoomModule):
         self.database = room_controller.database
 
         secrets = self.database.get_table("secrets")
-        username = secrets.get_row(secret_name='MagicHueUsername')['secret_value']
-        password = secrets.get_row(secret_name='MagicHuePassword')['secret_value']
+        self.username = secrets.get_row(secret_name='MagicHueUsername')['secret_value']
+        self.password = secrets.get_row(secret_name='MagicHuePassword')['secret_value']
 
+        self.api = None
+        self.devices = []
+        self.ready = False
+
+    def warm_up(self):
         try:
-            self.api = magichue.RemoteAPI.login_with_user_password(user=username, password=password)
+            self.api = magichue.RemoteAPI.login_with_user_password(user=self.username, password=self.password)
         except Exception as e:
             logging.error(f"MagicHueAPI: Failed to login to MagicHue API: {e}")
-            self.devices = []
-            self.ready = False
         else:
-            self.devices = []
-            self.ready = False
             self.fetch_all_devices()
 
         # self.state_changed = asyncio.Event()
@@ -3,9 +3,11 @@ from Modules.RoomControl.Decorators import background
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
 import asyncio
+import datetime
+import time
 
 try:
-    from bleak import BleakScanner, BleakClient
+    from bleak import BleakScanner
 except ImportError:
     logging.error("Failed to import bleak, please run 'pip install bleak' to install it")
     BleakScanner = None
@@ -25,60 +27,103 @@ class BluestalkerMk2(RoomModule):
 
 
 class BluestalkerMk2Object(RoomObject):
+    """
+    Passively tracks the targets from their BLE advertisements, a single long running scanner reports every
+    advertisement and each target's RSSI is smoothed so one weak or strong packet doesn't flip its presence
+    A target enters when its smoothed RSSI reaches enter_rssi and leaves when it drops below exit_rssi or it hasn't been
+    seen for exit_timeout seconds, occupants are published in the same format as the BlueStalker
+    """
     object_type = "Bluestalker"
 
+    enter_rssi = -75  # Smoothed RSSI a target has to reach to be considered present
+    exit_rssi = -85  # Smoothed RSSI a present target has to drop below to be considered absent
+    rssi_smoothing = 0.3  # Weight of each new reading in the moving average
+    exit_timeout = 60  # Seconds without an advertisement before a target is considered absent
+    check_interval = 5  # Seconds between checks for targets that have stopped advertising
+
     def __init__(self, room_controller):
         super().__init__("BluestalkerMk2", "Bluestalker")
-        self.targets = []
-        self.occupants = {}
         self.room_controller = room_controller
         self.database = room_controller.database
-
-        self.set_value("occupants", {})
-        self.set_value("occupied", None)
+        self.targets = {}  # type: dict[str, dict]  # Keyed by upper case address
+        self.sightings = {}  # type: dict[str, dict]  # Smoothed RSSI and last seen time of each target
+        self.occupants = {}  # type: dict[int, dict]
+        self.scanner = None
 
         table = self.database.get_table("bluetooth_targets")
         for row in table.get_rows():
-            self.targets.append((row["name"], row["address"]))
-            self.occupants[row["name"]] = False
+            self.targets[row["address"].upper()] = {"uuid": int(row["uuid"]), "address": row["address"],
+                                                    "name": row["name"], "role": row["role"]}
+
+        self.set_value("targets", {target["uuid"]: {"address": target["address"], "name": target["name"],
+                                                    "role": target["role"]} for target in self.targets.values()})
+        self.set_value("occupants", {})
+        self.set_value("occupied", False)
 
         logging.info(f"Found {len(self.targets)} bluetooth targets")
         self.room_controller.attach_object(self)
 
     async def start(self):
+        if BleakScanner is None:
+            logging.error("BluestalkerMk2: Bleak is not available, not starting")
+            return
         try:
-            logging.info(f"Starting Bluestalker2 connections to {len(self.targets)} targets")
-            connection_tasks = []
-
-            discovered = await BleakScanner.discover()
-            matches = [device for device in discovered if device.address in [target[1] for target in self.targets]]
-
-            logging.info(f"Found {len(matches)} devices out of {len(self.targets)}")
-
-            for target in self.targets:
-                connection_tasks.append(self.establish_connection(target))
-
-            await asyncio.gather(*connection_tasks)
-        except Exception as e:
-            logging.error(f"Failed to start Bluestalker2: {e}")
-
-    async def establish_connection(self, target):
-        return
-        target_name, target_device = target
-        try:
-            logging.info(f"Connecting to {target_name} ({target_device})")
-            self.occupants[target_name] = True
-            async with BleakClient(target_device) as client:
-                logging.warning(f"Lost connection to {client.address}")
-                self.occupants[target_name] = False
+            logging.info(f"BluestalkerMk2: Starting scanner for {len(self.targets)} targets")
+            self.scanner = BleakScanner(detection_callback=self._detection)
+            await self.scanner.start()
+            try:
+                while True:
+                    await asyncio.sleep(self.check_interval)
+                    self._expire()
+            finally:
+                await self.scanner.stop()
         except Exception as e:
-            logging.error(f"Failed to connect to ({target_name}, {target_device}): {e}")
-            self.occupants[target_name] = False
-        finally:
-            logging.warning(f"Disconnected from {target_name} ({target_device})")
+            logging.error(f"BluestalkerMk2: Scanner failed: {e}")
+            logging.exception(e)
+
+    def _detection(self, device, advertisement_data):
+        """Called on the event loop for every advertisement the scanner receives"""
+        target = self.targets.get(device.address.upper())
+        if target is None:
+            return
+        rssi = advertisement_data.rssi
+        sighting = self.sightings.get(target["address"])
+        if sighting is None:
+            sighting = self.sightings[target["address"]] = {"rssi": rssi, "last_seen": 0}
+        else:
+            sighting["rssi"] += (rssi - sighting["rssi"]) * self.rssi_smoothing
+        sighting["last_seen"] = time.monotonic()
+
+        present = target["uuid"] in self.occupants
+        if not present and sighting["rssi"] >= self.enter_rssi:
+            self._set_present(target, True)
+        elif present and sighting["rssi"] < self.exit_rssi:
+            self._set_present(target, False)
+
+    def _expire(self):
+        now = time.monotonic()
+        for target in self.targets.values():
+            sighting = self.sightings.get(target["address"])
+            if sighting is None or now - sighting["last_seen"] < self.exit_timeout:
+                continue
+            del self.sightings[target["address"]]  # Start averaging again from the next sighting
+            if target["uuid"] in self.occupants:
+                self._set_present(target, False)
+
+    def _set_present(self, target, present):
+        logging.info(f"BluestalkerMk2: {target['name']} has {'entered' if present else 'left'} the room")
+        if present:
+            self.occupants[target["uuid"]] = {"name": target["name"], "present": True, "address": target["address"],
+                                              "last_changed": datetime.datetime.now().timestamp()}
+        else:
+            self.occupants.pop(target["uuid"], None)
+        # Pass a copy, set_value compares against the stored value so passing the same dict would never emit a change
+        self.set_value("occupants", dict(self.occupants))
+        self.set_value("occupied", len(self.occupants) > 0)
+        self.emit_event("presence_changed", target["uuid"], present)
 
     def get_state(self):
         return {
-            "targets": self.targets,
+            "targets": self.get_value("targets"),
             "occupants": self.occupants
-        }
\ No newline at end of file
+        }
@@ -1,13 +1,18 @@
 import datetime
+import errno
 import json
 import os
+import selectors
+import socket
 import sqlite3
 import sys
+import threading
 import time
 
 import psutil
 from loguru import logger as logging
 
+from Modules.DatabaseUtils import run_batch
 from Modules.RoomControl.Decorators import background
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
@@ -25,6 +30,76 @@ except ImportError:
     bluetoothLE = None
 
 
+class RFCOMMProber:
+    """
+    Probes every target at once from the calling thread, a non-blocking RFCOMM connect is started for each target and
+    the sockets are waited on together with a selector, each target is given up on once its own deadline passes
+    A target is present if the connection completes or is refused (the device had to be in range to refuse it)
+    """
+
+    PRESENT = "present"
+    ABSENT = "absent"
+    ROUTE_LOST = "route_lost"  # The bluetooth adapter is unavailable
+
+    def __init__(self, connect_timeout=10.0, port=1):
+        self.connect_timeout = connect_timeout
+        self.port = port
+
+    @classmethod
+    def _classify(cls, error):
+        if error in (0, errno.ECONNREFUSED):
+            return cls.PRESENT
+        if error == errno.EHOSTUNREACH:
+            return cls.ROUTE_LOST
+        return cls.ABSENT
+
+    def probe(self, addresses, timeouts=None):
+        """
+        :param addresses: The addresses to probe
+        :param timeouts: Optional per address connect timeouts, defaults to connect_timeout
+        :return: {address: (result, socket)} the socket is the open connection for connected targets or None
+        """
+        results = {}
+        deadlines = {}
+        selector = selectors.DefaultSelector()
+        started = time.monotonic()
+        try:
+            for address in addresses:
+                sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+                sock.setblocking(False)
+                error = sock.connect_ex((address, self.port))
+                if error in (errno.EINPROGRESS, errno.EAGAIN):
+                    selector.register(sock, selectors.EVENT_WRITE, address)
+                    deadlines[address] = started + (timeouts or {}).get(address, self.connect_timeout)
+                    continue
+                results[address] = (self._classify(error), sock if error == 0 else None)
+                if error != 0:
+                    sock.close()
+            while deadlines:
+                timeout = max(0.0, min(deadlines.values()) - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    address = key.data
+                    selector.unregister(key.fileobj)
+                    del deadlines[address]
+                    error = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    results[address] = (self._classify(error), key.fileobj if error == 0 else None)
+                    if error != 0:
+                        key.fileobj.close()
+                now = time.monotonic()
+                for key in list(selector.get_map().values()):
+                    if deadlines[key.data] <= now:  # Timed out, the device is out of range
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        del deadlines[key.data]
+                        results[key.data] = (self.ABSENT, None)
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+        logging.debug(f"RFCOMMProber: Probed {len(results)} targets in {time.monotonic() - started:.2f} seconds")
+        return results
+
+
 class BluetoothDetector(RoomModule):
 
     def __init__(self, room_controller):
@@ -37,6 +112,7 @@ class BluetoothDetector(RoomModule):
 
 class BlueStalker(RoomObject):
     object_type = "BlueStalker"
+    flush_delay = 2  # Seconds occupancy changes are collected for before being written in one transaction
 
     def __init__(self, database: sqlite3.Connection, high_frequency_scan_enabled: bool = False):
         # Target file is a json file that contains bluetooth addresses, name, and role
@@ -45,6 +121,7 @@ class BlueStalker(RoomObject):
         self.init_database()
 
         self.sockets = {}
+        self.prober = RFCOMMProber()
         self.high_frequency_scan_enabled = high_frequency_scan_enabled
 
         self.last_checkup = 0
@@ -59,14 +136,26 @@ class BlueStalker(RoomObject):
 
         self.route_lost = False
 
+        # The targets table is cached here, call load_targets after changing it
+        self.targets_by_uuid = {}  # type: dict[int, dict]
+        self.targets_by_address = {}  # type: dict[str, dict]
+        self.target_mac_addresses = []
+        self.load_targets()
+
+        # The in memory occupancy table is authoritative, the database is only written to so it survives a restart
+        rows = self.database.get("SELECT uuid, in_room, last_changed FROM bluetooth_occupancy")
+        self.occupancy = {uuid: {"present": in_room == 1, "last_changed": last_changed}
+                          for uuid, in_room, last_changed in rows}  # type: dict[int, dict]
+        self.present_uuids = {uuid for uuid, entry in self.occupancy.items() if entry["present"]}
+        # Last occupancy state written for each uuid so only flips are persisted
+        self.persisted_occupancy = {uuid: entry["present"] for uuid, entry in self.occupancy.items()}
+        self.pending_occupancy = {}  # type: dict[int, tuple[bool, float]]
+        self.flush_lock = threading.Lock()
+        self.flush_timer = None
+
         self.set_value("occupants", {})
-        self.set_value("targets", {
-            int(data["uuid"]): {"address": data["address"], "name": data["name"], "role": data["role"]}
-            for data in self.get_targets()
-        })
         self.set_value("occupied", None)
         self.occupant_info = {}
-        self.target_mac_addresses = [target["address"] for target in self.get_targets()]
 
         if bluetooth is None or bluetoothLE is None:
             self.reboot_locked_out = True
@@ -74,7 +163,7 @@ class BlueStalker(RoomObject):
         # self.heartbeat_device = "38:1D:D9:F7:6D:44"
         # self.heartbeat_alive = False  # If the heartbeat device is alive
 
-        self.attach_event_callback(self.should_scan, "scan")
+        self.attach_event_callback(self.should_scan, "scan", dispatch="executor")  # Scanning blocks
 
         if bluetooth is not None:
             self.online = True
@@ -166,15 +255,28 @@ class BlueStalker(RoomObject):
             logging.warning("BlueStalker: Scan already in progress")
             return
 
-        self.scanning = True
-        conn_threads = []
-        for target in self.target_mac_addresses:
-            if self.sockets.get(target) is None:  # If the socket is already open
-                conn_threads.append(self.connect(target))  # Else attempt to connect to the device
+        if bluetooth is None:
+            self.fault = True
+            self.fault_message = "Bluetooth not available"
+            return
 
-        for thread in conn_threads:
-            thread.join()
-        self.scanning = False
+        self.scanning = True
+        try:
+            # Targets with an open connection are checked by life_check instead
+            targets = [target for target in self.target_mac_addresses if self.sockets.get(target) is None]
+            for address, (result, sock) in self.prober.probe(targets).items():
+                if result == RFCOMMProber.ROUTE_LOST:
+                    logging.error("BlueStalker: No route to host, bluetooth offline")
+                    self.route_lost = True
+                    continue
+                self.route_lost = False
+                if sock is not None:
+                    self.sockets[address] = sock
+                self.update_occupancy(address, result == RFCOMMProber.PRESENT)
+        except OSError as e:
+            logging.error(f"BlueStalker: Scan failed with error {e}")
+        finally:
+            self.scanning = False
         self.last_scan = datetime.datetime.now().timestamp()  # Update the last update time
 
     def determine_health(self):
@@ -235,58 +337,10 @@ class BlueStalker(RoomObject):
         self.fault = True
         self.fault_message = "Refresh loop exited"
 
-    @background
-    def connect(self, address):
-        if bluetooth is None:
-            self.fault = True
-            self.fault_message = "Bluetooth not available"
-            return
-        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        sock.setblocking(True)  # Set the socket to non-blocking
-        try:
-            logging.debug(f"BlueStalker: Connecting to {address}, timeout {sock.gettimeout()}")
-            sock.connect((address, 1))  # Start the connection (Will fail with EINPROGRESS)
-        except bluetooth.btcommon.BluetoothError as e:
-            if e.__str__() == "[Errno 111] Connection refused":  # Connection refused still counts as a connection as
-                # the device had to be in range to refuse the connection
-                logging.error(f"BlueStalker: Connection to address {address} refused, device is in range")
-                self.update_occupancy(address, True)
-                return
-            elif e.__str__() == "[Errno 115] Operation now in progress":  # This is the error we expect to see
-                logging.debug(f"BlueStalker: Connection to {address} is in progress")
-                self.update_occupancy(address, False)
-                self.sockets[address] = sock  # Add the socket to the list of sockets
-                time.sleep(2.5)  # Wait for the connection to complete
-                self.conn_is_alive(sock, address)  # Check if the connection is still alive
-                return
-            elif e.__str__() == "[Errno 113] No route to host":
-                # Happens when the Bluetooth adapter is not available
-                logging.error(f"BlueStalker: No route to host, bluetooth offline")
-                self.route_lost = True
-                return
-            else:  # Any other error is unexpected
-                logging.error(f"BlueStalker: Connection to address {address} failed with error {e}")
-                self.update_occupancy(address, False)
-                return
-        except OSError as e:  # Any additional errors that the OS throws are caught here
-            logging.error(f"BlueStalker: Failed to connect to {address} with error {e}")
-            self.update_occupancy(address, False)
-            return
-        else:
-            logging.debug(f"BlueStalker: Connected to {address}")
-            self.sockets[address] = sock
-            self.route_lost = False
-            self.update_occupancy(address, True)
-
-    @background
     def conn_is_alive(self, connection, address):
         logging.debug(f"BlueStalker: Checking if {address} is alive")
         try:
             connection.getpeername()
-        except bluetooth.BluetoothError as e:
-            logging.debug(f"BlueStalker: Connection to {address} is dead, reason: {e}")
-            self.update_occupancy(address, False)
-            self.sockets.pop(address)
         except OSError as e:
             logging.debug(f"BlueStalker: Connection to {address} is dead, reason: {e}")
             connection.close()
@@ -296,80 +350,96 @@ class BlueStalker(RoomObject):
             # logging.info(f"Connection to {address} is alive")
             self.update_occupancy(address, True)
 
+    def load_targets(self):
+        """Load the targets table into the address and uuid indexes"""
+        targets = self.get_targets()
+        self.targets_by_uuid = {int(target["uuid"]): target for target in targets}
+        self.targets_by_address = {target["address"]: target for target in targets}
+        self.target_mac_addresses = [target["address"] for target in targets]
+        self.set_value("targets", {
+            int(data["uuid"]): {"address": data["address"], "name": data["name"], "role": data["role"]}
+            for data in targets
+        })
+
     def update_occupancy(self, address, in_room):
-        # Get the UUID of the mac address
-        cursor = self.database.cursor()
-        cursor.execute("SELECT uuid FROM bluetooth_targets WHERE address=?", (address,))
-        uuid = cursor.fetchone()[0]
-        cursor.close()
-        if uuid == 0:
+        target = self.targets_by_address.get(address)
+        if target is None:
             logging.error(f"Failed to get UUID for {address}")
             return
-        if in_room:
-            self.occupant_info.update({uuid: {"name": self.get_name(uuid), "present": in_room,
-                                              "address": address, "last_changed": datetime.datetime.now().timestamp()}})
-        else:
-            if uuid in self.occupant_info:
+        uuid = int(target["uuid"])
+        # Occupants are only republished when who is present changes, probing a target that is already present keeps
+        # its entry (and last_changed) as it was so the probe doesn't look like an occupancy change
+        occupants = None
+        with self.flush_lock:
+            if in_room and uuid not in self.occupant_info:
+                self.occupant_info[uuid] = {"name": self.get_name(uuid), "present": True, "address": address,
+                                            "last_changed": datetime.datetime.now().timestamp()}
+                occupants = dict(self.occupant_info)
+            elif not in_room and uuid in self.occupant_info:
                 self.occupant_info.pop(uuid)
-        self.set_value("occupants", self.occupant_info)
-
-        # Check if an occupancy entry exists for the address
-        self.database.lock.acquire()
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_occupancy WHERE uuid=?", (uuid,))
-        if cursor.fetchone() is None:
-            # Check if the db state matches in_room, if it is, we don't need to update the database
-            cursor.execute("INSERT INTO bluetooth_occupancy (uuid, in_room, last_changed) VALUES (?, ?, ?)",
-                           (uuid, in_room, datetime.datetime.now().timestamp()))
-
-            self.database.commit()
-            self.database.lock.release()
-        else:
-            cursor.execute("UPDATE bluetooth_occupancy SET in_room=?, last_changed=? WHERE uuid=?",
-                           (in_room, datetime.datetime.now().timestamp(), uuid))
-            self.database.commit()
-            self.database.lock.release()
+                occupants = dict(self.occupant_info)
+        if occupants is not None:
+            # Pass a copy, set_value compares against the stored value so passing the same dict would never emit
+            self.set_value("occupants", occupants)
+
+        # Only a change of state is written, the writes are batched into one transaction by _flush_occupancy
+        with self.flush_lock:
+            entry = self.occupancy.get(uuid)
+            if entry is not None and entry["present"] == in_room:
+                return
+            changed = datetime.datetime.now().timestamp()
+            self.occupancy[uuid] = {"present": in_room, "last_changed": changed}
+            if in_room:
+                self.present_uuids.add(uuid)
+            else:
+                self.present_uuids.discard(uuid)
+            self.pending_occupancy[uuid] = (in_room, changed)
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_delay, self._flush_occupancy)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        self.emit_event("presence_changed", uuid, in_room)
+
+    def _flush_occupancy(self):
+        # Held for the whole flush so persisted_occupancy is never read and updated by two threads at once
+        with self.flush_lock:
+            pending, self.pending_occupancy = self.pending_occupancy, {}
+            self.flush_timer = None
+            rows = [(uuid, in_room, changed) for uuid, (in_room, changed) in pending.items()
+                    if self.persisted_occupancy.get(uuid) != in_room]
+            if not rows:
+                return
+            try:
+                run_batch(self.database, "INSERT INTO bluetooth_occupancy (uuid, in_room, last_changed) "
+                                         "VALUES (?, ?, ?) ON CONFLICT(uuid) DO UPDATE SET in_room=excluded.in_room, "
+                                         "last_changed=excluded.last_changed", rows)
+            except sqlite3.Error as e:
+                logging.error(f"BlueStalker: Failed to save occupancy changes: {e}")
+                # Nothing was written, keep the changes for the next flush unless a newer change replaced them
+                for uuid, change in pending.items():
+                    self.pending_occupancy.setdefault(uuid, change)
+                return
+            for uuid, in_room, _ in rows:
+                self.persisted_occupancy[uuid] = in_room
+        logging.debug(f"BlueStalker: Saved {len(rows)} occupancy changes")
 
     def get_occupancy(self):
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_occupancy")
-        occupancy = cursor.fetchall()
-        cursor.close()
-        # Get the names of the devices combine this with the occupancy
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_targets")
-        targets = cursor.fetchall()
-        cursor.close()
-
         occupancy_info = {}
-        for target in targets:
-            for device in occupancy:
-                if target[0] == device[0]:
-                    present = True if device[1] == 1 else False
-                    occupancy_info[target[2]] = {"present": present, "last_changed": device[2], "uuid": target[0]}
-
+        for uuid, entry in list(self.occupancy.items()):
+            target = self.targets_by_uuid.get(uuid)
+            if target is not None:
+                occupancy_info[target["name"]] = {"present": entry["present"], "last_changed": entry["last_changed"],
+                                                  "uuid": uuid}
         return occupancy_info
 
     def get_occupants_names(self):
         """Gets current occupants and only returns their names"""
-        occupants = self.get_occupancy()
-        occupants_names = []
-        for occupant in occupants:
-            if occupants[occupant]["present"]:
-                occupants_names.append(occupant)
-        return occupants_names
+        return [self.targets_by_uuid[uuid]["name"] for uuid in list(self.present_uuids) if uuid in self.targets_by_uuid]
 
     def is_occupied(self):
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_occupancy")
-        occupancy = cursor.fetchall()
-        cursor.close()
         if not self.enabled:
             return False
-        for device in occupancy:
-            if device[1] == 1:
-                return True
-        return False
+        return len(self.present_uuids) > 0
 
     def get_targets(self):
         # Return a list of uuids
@@ -383,39 +453,24 @@ class BlueStalker(RoomObject):
         return results
 
     def get_combined_target_info(self, uuid):
-
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_occupancy WHERE uuid=?", (uuid,))
-        device = cursor.fetchone()
-        cursor.close()
-        # Get the names of the devices combine this with the occupancy
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_targets WHERE uuid=?", (uuid,))
-        target = cursor.fetchone()
-        cursor.close()
-
-        present = True if device[1] == 1 else False
-        return {"present": present, "last_changed": device[2], "uuid": target[0]}
+        entry = self.occupancy.get(int(uuid))
+        if entry is None:
+            return None
+        return {"present": entry["present"], "last_changed": entry["last_changed"], "uuid": int(uuid)}
 
     def is_here(self, uuid):
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_occupancy WHERE uuid=?", (uuid,))
-        device = cursor.fetchone()
-        if device is None:
+        entry = self.occupancy.get(int(uuid))
+        if entry is None:
             return None
-        cursor.close()
         if not self.enabled:
             return False
-        return True if device[1] == 1 else False
+        return entry["present"]
 
     def get_name(self, uuid):
-        cursor = self.database.cursor()
-        cursor.execute("SELECT * FROM bluetooth_targets WHERE uuid=?", (uuid,))
-        device = cursor.fetchone()
-        if device is None:
+        target = self.targets_by_uuid.get(int(uuid))
+        if target is None:
             return None
-        cursor.close()
-        return device[2]
+        return target["name"]
 
     ### API Methods ###
 
@@ -1,56 +1,51 @@
+import asyncio
 import datetime
 import os
+import re
 import sqlite3
 import time
 
+from Modules.DatabaseUtils import run_batch
 from Modules.RoomControl.Decorators import background
-import subprocess
-import pyparsing as pp
 
 from loguru import logger as logging
 
-def ping(ip_address, count=4, timeout=1) -> (float, float):
-    if os.name == "nt":
-        command = f"ping -n {count} -w {timeout * 1000} {ip_address}"
-    else:
-        command = f"ping -c {count} -W {timeout} {ip_address}"
-
-    logging.info(f"Running command: {command}")
+# Compiled once, ping output is parsed for every device on every sweep
+PACKET_LOSS = re.compile(r"([\d.]+)% (?:packet )?loss")
+AVERAGE_TIME = re.compile(r"(?:min/avg/max/\w+ = [\d.]+/([\d.]+)/|Average = (\d+)ms)")
 
-    result = subprocess.run(command, shell=True, capture_output=True)
 
-    # Get the average time and the packet loss
-    output = result.stdout.decode("utf-8")
-    logging.info(f"Output: {output}")
-
-    # Get the average time
-    try:
+async def ping(ip_address, count=4, timeout=1) -> (float, float):
+    """
+    Ping an address without blocking the event loop, so every device can be pinged at once
+    :return: The average round trip time in ms (None if nothing came back) and the packet loss from 0 to 1
+    """
+    if os.name == "nt":
+        command = ("ping", "-n", str(count), "-w", str(timeout * 1000), ip_address)
+    else:
+        command = ("ping", "-c", str(count), "-W", str(timeout), ip_address)
 
-        if os.name == "nt":
-            packet_loss = pp.Word(pp.nums) + "%"
-            average_time = pp.Word("Average = ") + pp.Word(pp.nums) + "ms"
-        else:
-            packet_loss = pp.Word(pp.nums) + "%"
-            average_time = pp.Word("time=") + pp.Word(pp.nums) + "ms"
+    logging.debug(f"Running command: {' '.join(command)}")
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    output = stdout.decode("utf-8", errors="replace")
 
-        packet_loss = packet_loss.parseString(output)
-        average_time = average_time.parseString(output)
-    except pp.ParseException as e:
-        logging.info(f"Failed to parse output: {e}")
+    packet_loss = PACKET_LOSS.search(output)
+    if packet_loss is None:
+        logging.info(f"Failed to parse ping output for {ip_address}: {output}")
         return None, 1
+    average_time = AVERAGE_TIME.search(output)
+    average_time = float(average_time.group(1) or average_time.group(2)) if average_time else None
+    return average_time, float(packet_loss.group(1)) / 100
 
-    packet_loss = float(packet_loss[0])
-    average_time = float(average_time[0])
-
-    return average_time, packet_loss / 100
 
 class Device:
 
-    def __init__(self, name: str, database: sqlite3.Connection):
-        self.name = name
+    def __init__(self, entry, database: sqlite3.Connection):
+        self.name = entry[0]
         self.database = database
-        self.entry = self.database.run("SELECT * FROM network_occupancy WHERE name=?", (name,))
-        self.entry = self.entry.fetchone()
+        self.entry = entry
 
         # Database values
         self.on_campus = self.entry[1]
@@ -81,12 +76,12 @@ class Device:
     def on_campus(self):
         return self.on_campus
 
-    def ping(self):
+    async def ping(self):
         # Pings the device and returns True if the ping was successful
         try:
             logging.info(f"Pinging {self.name}")
             timeout = 1
-            response = ping(self.ip_address, timeout=timeout, count=4)
+            response = await ping(self.ip_address, timeout=timeout, count=4)
             if response[1] == 0:
                 logging.info(f"Ping successful for {self.name}, RTT: {response[0]}")
                 self.missed_pings = 0
@@ -120,15 +115,15 @@ class Device:
             else:
                 return False
 
-    def update_db(self):
-        # Updates the database with the current values
-        self.database.run("UPDATE network_occupancy SET on_campus=?, last_seen=? WHERE name=?",
-                          (self.on_campus, self.last_seen.timestamp(), self.name))
+    def db_row(self):
+        # The values written back to the database by NetworkOccupancyDetector.update_db
+        return self.on_campus, self.last_seen.timestamp(), self.name
 
     def fetch_ip(self):
         # The device ip is updated by the device in the database, so periodically fetch the ip from the database
         if datetime.datetime.now() - self.last_ip_update > datetime.timedelta(minutes=5):
-            values = self.database.run("SELECT ip_address, last_ip_update FROM network_occupancy WHERE name=?", (self.name,))
+            values = self.database.run("SELECT ip_address, last_ip_update FROM network_occupancy WHERE name=?",
+                                       (self.name,)).fetchone()
             self.ip_address = values[0]
             self.last_ip_update = datetime.datetime.fromtimestamp(values[1])
 
@@ -140,10 +135,16 @@ class NetworkOccupancyDetector:
     If a device misses a ping then it is pinged 4 times in 15 second intervals and if it misses
      all 4 then it is assumed to be off campus and the database is updated
     Devices that are believed to be off campus are pinged every minute
+    Every device due a ping is pinged at once and the results are written back in one transaction per sweep
     """
 
-    def __init__(self, database: sqlite3.Connection):
+    def __init__(self, database: sqlite3.Connection, on_update=None):
+        """
+        :param database: The database the devices are stored in
+        :param on_update: Called with (name, on_campus) for every device after each ping
+        """
         self.database = database
+        self.on_update = on_update
         self.init_database()
         self.devices = []
         self.load_devices()
@@ -159,7 +160,7 @@ class NetworkOccupancyDetector:
         cursor.execute("SELECT * FROM network_occupancy")
         rows = cursor.fetchall()
         for row in rows:
-            self.devices.append(Device(row[0], self.database))
+            self.devices.append(Device(row, self.database))
 
     def valid_ip(self, ip: str):
         # Checks if the IP address is a valid MTU IP address (subnet 141.219.x.x)
@@ -172,15 +173,32 @@ class NetworkOccupancyDetector:
                 return device.on_campus
         return False
 
+    async def sweep(self):
+        due = [device for device in self.devices if device.needs_ping()]
+        if not due:
+            return
+        started = time.perf_counter()
+        await asyncio.gather(*(device.ping() for device in due))
+        logging.debug(f"Pinged {len(due)} devices in {time.perf_counter() - started:.2f} seconds")
+        self.update_db(due)
+        if self.on_update is not None:
+            for device in due:
+                self.on_update(device.get_name(), device.on_campus)
+
+    def update_db(self, devices):
+        # Updates the database with the current values of the devices
+        try:
+            run_batch(self.database, "UPDATE network_occupancy SET on_campus=?, last_seen=? WHERE name=?",
+                      [device.db_row() for device in devices])
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save network occupancy: {e}")
+
     @background
     def net_detect_periodic_refresh(self):
         logging.info("Starting periodic refresh")
         while True:
             try:
-                for device in self.devices:
-                    if device.needs_ping():
-                        device.ping()
-                        device.update_db()
+                asyncio.run(self.sweep())
             except Exception as e:
                 logging.error(f"Error in periodic refresh: {e}")
             finally:
@@ -1,11 +1,14 @@
 from Modules.RoomControl.OccupancyDetection.BluetoothOccupancy import BluetoothDetector
+import threading
 import time
 
 from Modules.RoomControl.Decorators import background
 from Modules.RoomControl.OccupancyDetection.MTUNetOccupancy import NetworkOccupancyDetector
+from Modules.RoomControl.OccupancyDetection.PresenceFusion import PresenceFusion
 
 from loguru import logger as logging
 
+from Modules.EventBus import event_bus
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
 
@@ -17,6 +20,17 @@ except ImportError:
 
 
 class OccupancyDetector(RoomModule):
+    """
+    Combines the occupancy sources, changes are published on the event bus under the name OccupancyDetector as
+    occupancy_changed, motion_detected, activity_expired and health_changed
+    Who is present is decided by fusing the evidence of every source in a PresenceFusion, occupancy_changed is only
+    published when someone's fused presence changes and carries {target: present} for the targets that changed
+    """
+
+    event_source = "OccupancyDetector"
+    events = ("occupancy_changed", "motion_detected", "activity_expired", "health_changed")
+    activity_window = 60  # Seconds after motion that activity is considered recent
+    fusion_interval = 5  # Seconds between re-evaluations of the fused presence so faded evidence is noticed
 
     def __init__(self, room_controller):
         super().__init__(room_controller)
@@ -24,6 +38,12 @@ class OccupancyDetector(RoomModule):
         self.database = room_controller.database
         self.database_init()
         self.last_activity = 0  # type: int # Last time a user was detected either by door or motion sensor
+        self.activity_timer = None  # type: threading.Timer # Publishes activity_expired once the window has passed
+        # Index of the stalkers' targets and the fused presence so occupancy queries don't walk every stalker
+        self.index_lock = threading.Lock()
+        self.fusion = PresenceFusion(self.database)
+        self.target_names = {}  # type: dict[int, str]
+        self.indexed_values = []  # The occupants and targets values the index was built from
 
         # if GPIO:
         #     GPIO.setmode(GPIO.BOARD)
@@ -39,10 +59,24 @@ class OccupancyDetector(RoomModule):
         self.blue_stalkers = []
         self.blue_stalkers.append(self.room_controller.get_object("BlueStalker"))
         self.blue_stalkers.append(self.room_controller.get_object("BlueStalker2"))
+        for stalker in self.blue_stalkers:
+            stalker.attach_event_callback(self._occupants_changed, "on_occupants_update")
+            stalker.attach_event_callback(self._targets_changed, "on_targets_update")
+            stalker.attach_event_callback(self._health_changed, "on_health_update")
+        # Each source of presence evidence and the kind of source it is to the fusion
+        self.presence_sources = [(stalker, "bluetooth") for stalker in self.blue_stalkers]
+        ble_stalker = self.room_controller.get_object("BluestalkerMk2")
+        ble_stalker.attach_event_callback(self._occupants_changed, "on_occupants_update")
+        ble_stalker.attach_event_callback(self._targets_changed, "on_targets_update")
+        self.presence_sources.append((ble_stalker, "ble"))
+        # Devices pinged on the campus network, matched to targets by name
+        self.network_detector = NetworkOccupancyDetector(self.database, on_update=self.network_presence)
         self.motion_detector = self.room_controller.get_object("MotionDetector")
-        self.motion_detector.attach_event_callback(self.motion_detected, "motion_detected")
+        # Motion fans out scan requests to the stalkers so it shouldn't hold up the motion detector
+        self.motion_detector.attach_event_callback(self.motion_detected, "motion_detected", dispatch="executor")
 
         self.periodic_update()
+        self.fusion_refresh()
 
     def database_init(self):
         self.database.run("""
@@ -80,9 +114,98 @@ class OccupancyDetector(RoomModule):
             #     self.blue_stalker.high_frequency_scan_enabled = True
             time.sleep(5)
 
+    @background
+    def fusion_refresh(self):
+        while True:
+            time.sleep(self.fusion_interval)
+            try:
+                # The stalkers only publish when someone arrives or leaves, so what they currently report is handed
+                # to the fusion again on every tick, otherwise evidence with a half life (BLE) would fade while the
+                # person is still there, the stalkers age people out themselves once they stop seeing them
+                self._rebuild_index()
+                self._fuse()
+            except Exception as e:
+                logging.error(f"OccupancyDetector: Error refreshing fused presence: {e}")
+                logging.exception(e)
+
+    def _fuse(self):
+        changes = self.fusion.update()
+        if changes:
+            logging.info(f"OccupancyDetector: Presence changed {changes}")
+            event_bus.publish(self.event_source, "occupancy_changed", changes)
+
+    def _occupants_changed(self, occupants):
+        self._rebuild_index()  # Rebuilt before fusing so subscribers see the new occupancy
+        self._fuse()
+
+    @staticmethod
+    def _target_id(uuid):
+        """Targets are keyed by integer uuids but arrive as strings from satellites"""
+        try:
+            return int(uuid)
+        except (TypeError, ValueError):
+            return uuid
+
+    def _stalker_values(self):
+        return [(stalker.get_value("occupants"), stalker.get_value("targets")) for stalker, _ in self.presence_sources]
+
+    def _rebuild_index(self):
+        """Rebuild the target names and hand every source's current occupants to the fusion as evidence"""
+        with self.index_lock:
+            values = self._stalker_values()
+            names = {}
+            for (stalker, kind), (occupants, targets) in zip(self.presence_sources, values):
+                if isinstance(targets, dict):
+                    for uuid, details in targets.items():
+                        names.setdefault(self._target_id(uuid), details.get("name", "Unknown"))
+                health = stalker.get_health()
+                if not isinstance(occupants, dict) or (health is not None and not health["online"]):
+                    self.fusion.clear(stalker.object_name)  # An offline source is no evidence either way
+                    continue
+                observations = {self._target_id(uuid): False for uuid in targets} if isinstance(targets, dict) else {}
+                observations.update({self._target_id(uuid): True for uuid in occupants.keys()})
+                self.fusion.replace(kind, observations, source_key=stalker.object_name)
+            self.target_names = names
+            self.indexed_values = values
+
+    def _check_index(self):
+        """Rebuild the index if a stalker's values were replaced without a change event (e.g. a promise was swapped)"""
+        values = self._stalker_values()
+        if len(values) != len(self.indexed_values) or any(
+                current[0] is not indexed[0] or current[1] is not indexed[1]
+                for current, indexed in zip(values, self.indexed_values)):
+            self._rebuild_index()
+
+    def _targets_changed(self, targets):
+        self._rebuild_index()
+
+    def network_presence(self, name, on_campus):
+        """Evidence from the NetworkOccupancyDetector, called after every ping of a device"""
+        for target, target_name in list(self.target_names.items()):
+            if target_name == name:
+                self.fusion.observe(target, "network", on_campus)
+        self._fuse()
+
+    def _health_changed(self, health):
+        self._rebuild_index()  # Drops or restores the evidence of a stalker that went offline or came back
+        self._fuse()
+        event_bus.publish(self.event_source, "health_changed")
+
+    def _activity_expired(self):
+        if not self.was_activity_recent():
+            event_bus.publish(self.event_source, "activity_expired")
+
     def motion_detected(self, state):
         logging.info("Motion event received")
         self.last_activity = time.time()
+        self.fusion.observe(PresenceFusion.room, "motion", True)
+        self._fuse()
+        if self.activity_timer is not None:
+            self.activity_timer.cancel()
+        self.activity_timer = threading.Timer(self.activity_window, self._activity_expired)
+        self.activity_timer.daemon = True
+        self.activity_timer.start()
+        event_bus.publish(self.event_source, "motion_detected")
         for stalker in self.blue_stalkers:
             try:
                 stalker.emit_event("scan")
@@ -98,34 +221,22 @@ class OccupancyDetector(RoomModule):
                     return False
         return True
 
-    def was_activity_recent(self, seconds=60):
+    def was_activity_recent(self, seconds=activity_window):
         return self.last_activity + seconds > time.time()
 
     def is_here(self, device):
-        for source in self.blue_stalkers:
-            try:
-                if source.get_value("occupants") is not None:
-                    for uuid, details in source.get_value("occupants").items():
-                        if int(uuid) == device:
-                            return True
-            except Exception as e:
-                logging.error(f"Error checking if device is here: {e}")
-        return False
+        # A rebuild here only updates the evidence, occupancy_changed is published by the next event or refresh since
+        # publishing from inside a consumer's query would re-enter the consumer, is_present answers from the evidence
+        self._check_index()
+        return self.fusion.is_present(self._target_id(device))
 
     def get_name(self, device):
-        for source in self.blue_stalkers:
-            try:
-                if device in source.get_value("targets").keys():
-                    return source.get_value("targets")[device]["name"]
-            except Exception as e:
-                logging.error(f"Error getting device name: {e}")
-        return "Unknown"
+        self._check_index()
+        return self.target_names.get(self._target_id(device), "Unknown")
 
     def get_all_devices(self):
-        devices = []
-        for source in self.blue_stalkers:
-            devices.extend(source.get_value("targets").keys())
-        return devices
+        self._check_index()
+        return list(self.target_names.keys())
 
     def get_device(self, device_id):
         return "Not implemented yet"
@@ -0,0 +1,176 @@
+import math
+import threading
+import time
+
+
+class EvidenceSource:
+    """How far an observation from a kind of source moves a person's log-odds of being present and how fast it fades"""
+
+    __slots__ = ("present_weight", "absent_weight", "half_life")
+
+    def __init__(self, present_weight, absent_weight, half_life=None):
+        """
+        :param present_weight: Log-odds added when the source sees the person
+        :param absent_weight: Log-odds added when the source reports the person missing (usually negative)
+        :param half_life: Seconds for the observation to lose half its weight, None if it holds until replaced
+        """
+        self.present_weight = present_weight
+        self.absent_weight = absent_weight
+        self.half_life = half_life
+
+    def weight(self, observation, age):
+        weight = self.present_weight if observation else self.absent_weight
+        if self.half_life is None:
+            return weight
+        return weight * 0.5 ** (max(0.0, age) / self.half_life)
+
+
+class PresenceFusion:
+    """
+    Fuses timestamped presence evidence from every occupancy source into a probability per person
+    Each observation adds its source's weight to the person's log-odds and fades with the source's half life, when
+    several sources of the same kind report on a person only the strongest one counts (any stalker seeing them wins)
+    Evidence about the room rather than a person (motion) is added to everyone, presence flips at enter_probability
+    and back at exit_probability so a probability hovering around one threshold doesn't flap
+    The weights are loaded from the presence_fusion_sources table and the prior and thresholds from the
+    presence_fusion_settings table, both are filled with the defaults below the first time they are created
+    """
+
+    default_settings = {
+        "prior": -1.0,  # Log-odds of a person being present with no evidence
+        "enter_probability": 0.7,
+        "exit_probability": 0.3,
+    }
+    default_sources = {  # (present weight, absent weight, half life)
+        "bluetooth": (4.0, -3.0, None),  # RFCOMM probes, refreshed by every scan
+        "ble": (2.0, -1.0, 120),  # Passive advertisements, noisier than a connection
+        "network": (0.5, -3.0, 600),  # Campus network pings, on campus says little, off campus says a lot
+        "motion": (1.5, 0.0, 60),  # Someone is in the room, not who
+    }
+    room = None  # The person evidence about the whole room is recorded under
+
+    def __init__(self, database=None, clock=time.time):
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.evidence = {}  # type: dict[tuple, tuple[str, bool, float]]  # (person, source key) -> observation
+        self.people = set()
+        self.present = set()
+
+        self.prior = self.default_settings["prior"]
+        self.enter_probability = self.default_settings["enter_probability"]
+        self.exit_probability = self.default_settings["exit_probability"]
+        self.sources = {name: EvidenceSource(*weights) for name, weights in self.default_sources.items()}
+        if database is not None:
+            self.database_init(database)
+            self.load(database)
+
+    def database_init(self, database):
+        database.create_table("presence_fusion_sources", {"name": "TEXT", "present_weight": "FLOAT",
+                                                          "absent_weight": "FLOAT", "half_life": "FLOAT"},
+                              primary_keys=["name"])
+        database.create_table("presence_fusion_settings", {"name": "TEXT", "value": "FLOAT"}, primary_keys=["name"])
+        for name, (present_weight, absent_weight, half_life) in self.default_sources.items():
+            database.run("INSERT OR IGNORE INTO presence_fusion_sources (name, present_weight, absent_weight, "
+                         "half_life) VALUES (?, ?, ?, ?)", (name, present_weight, absent_weight, half_life))
+        for name, value in self.default_settings.items():
+            database.run("INSERT OR IGNORE INTO presence_fusion_settings (name, value) VALUES (?, ?)", (name, value))
+
+    def load(self, database):
+        """Load the source weights and settings, sources missing from the table keep their defaults"""
+        for name, present_weight, absent_weight, half_life in database.get(
+                "SELECT name, present_weight, absent_weight, half_life FROM presence_fusion_sources"):
+            self.sources[name] = EvidenceSource(present_weight, absent_weight, half_life)
+        for name, value in database.get("SELECT name, value FROM presence_fusion_settings"):
+            if name in self.default_settings:
+                setattr(self, name, value)
+
+    def observe(self, person, source, observation, source_key=None, timestamp=None):
+        """
+        Record an observation, it replaces the previous observation of the person by the same source
+        :param person: The person the observation is about, or PresenceFusion.room
+        :param source: The kind of source (a key of PresenceFusion.sources)
+        :param observation: True if the source sees the person
+        :param source_key: Identifies the individual source (e.g. the stalker's name), defaults to the kind of source
+        :param timestamp: When the observation was made, defaults to now
+        """
+        if source not in self.sources:
+            raise ValueError(f"Unknown presence source {source}")
+        with self.lock:
+            if person is not self.room:
+                self.people.add(person)
+            self.evidence[(person, source_key or source)] = \
+                (source, observation, self.clock() if timestamp is None else timestamp)
+
+    def replace(self, source, observations, source_key=None, timestamp=None):
+        """
+        Replace everything a source has reported with a new set of observations
+        :param observations: {person: observation} people the source no longer reports on are forgotten
+        """
+        source_key = source_key or source
+        timestamp = self.clock() if timestamp is None else timestamp
+        with self.lock:
+            for key in [key for key in self.evidence if key[1] == source_key and key[0] not in observations]:
+                del self.evidence[key]
+        for person, observation in observations.items():
+            self.observe(person, source, observation, source_key, timestamp)
+
+    def clear(self, source_key):
+        """Forget everything a source has reported, used when the source goes offline"""
+        with self.lock:
+            for key in [key for key in self.evidence if key[1] == source_key]:
+                del self.evidence[key]
+
+    def _log_odds(self, person, now):
+        strongest = {}
+        for (subject, _), (source, observation, timestamp) in self.evidence.items():
+            if subject == person or subject is self.room:
+                weight = self.sources[source].weight(observation, now - timestamp)
+                if source not in strongest or weight > strongest[source]:
+                    strongest[source] = weight
+        return self.prior + sum(strongest.values())
+
+    def probability(self, person):
+        with self.lock:
+            return self._probability(person, self.clock())
+
+    def _probability(self, person, now):
+        return 1 / (1 + math.exp(-self._log_odds(person, now)))
+
+    def update(self):
+        """
+        Re-evaluate everyone's presence, called after new evidence and periodically so faded evidence is noticed
+        :return: {person: present} for every person whose presence changed
+        """
+        changes = {}
+        with self.lock:
+            now = self.clock()
+            for person in self.people:
+                probability = self._probability(person, now)
+                if person not in self.present and probability >= self.enter_probability:
+                    self.present.add(person)
+                    changes[person] = True
+                elif person in self.present and probability <= self.exit_probability:
+                    self.present.discard(person)
+                    changes[person] = False
+            # Drop evidence that has faded to nothing so the table doesn't grow forever
+            for key, (source, observation, timestamp) in list(self.evidence.items()):
+                if abs(self.sources[source].weight(observation, now - timestamp)) < 0.01:
+                    del self.evidence[key]
+        return changes
+
+    def is_present(self, person):
+        """
+        Whether the person is present given the evidence right now, the hysteresis state is only advanced by update
+        so this answers from the current probability without waiting for the next update
+        """
+        with self.lock:
+            if person not in self.people:
+                return False
+            probability = self._probability(person, self.clock())
+            if person in self.present:
+                return probability > self.exit_probability
+            return probability >= self.enter_probability
+
+    def get_state(self):
+        return {str(person): {"present": person in self.present, "probability": round(self.probability(person), 3)}
+                for person in list(self.people)}
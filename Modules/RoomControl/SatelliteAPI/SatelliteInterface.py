@@ -1,4 +1,5 @@
 import asyncio
+import hmac
 import time
 
 import aiohttp
@@ -92,17 +93,26 @@ class SatelliteObject(RoomObject):
 
 
 class Satellite:
+    batch_window = 0.005  # Seconds to wait after the first downlink event for more to join its batch
+    max_batch = 50  # Most events sent in one batch
+    full_snapshot_interval = 600  # Seconds between full snapshots requested from v2 satellites as a safety net
+    last_seen_interval = 30  # Seconds between writes of last_seen to the database
 
     def __init__(self, name, ip, auth, room_controller):
         self.name = name
         self.ip = ip
         self.auth = auth
         self.last_seen = 0
-        self.objects = []  # type: list[RoomObject]
+        self.objects = {}  # type: dict[str, RoomObject]
         self.subscribed_objects = []  # type: list[RoomObject]  # Objects that this satellite listens to
         self.room_controller = room_controller
         self.downlink_queue = asyncio.Queue()  # Allow transfer of downlink events from a non-async context
         self.uplink_queue = asyncio.Queue()  # Allow transfer of uplink events from a non-async context
+        self.session = None  # type: aiohttp.ClientSession  # Kept open so downlinks reuse the connection
+        self.batch_supported = True  # Cleared if the satellite doesn't have the /event_batch route
+        self.uplink_seq = None  # Sequence number of the last v2 uplink applied, None until a full snapshot arrives
+        self.last_full_snapshot = 0
+        self.last_seen_saved = 0
 
     @property
     def online(self):
@@ -118,47 +128,123 @@ class Satellite:
             if obj.object_type == "RoomObject" or obj.object_type == "promise":
                 new_obj = SatelliteObject(object_name, f"satellite_{object_type}", self)
                 self.room_controller.attach_object(new_obj)
-                self.objects.append(new_obj)
+                self.objects[object_name] = new_obj
                 return new_obj
             else:
                 if obj.object_type != f"satellite_{object_type}":
                     logging.warning(f"Object {object_name} already exists but is not of type {object_type} but"
                                     f" it is type {obj.object_type}")
-                self.objects.append(obj)
+                self.objects[object_name] = obj
                 return obj
         else:
             new_obj = SatelliteObject(object_name, f"satellite_{object_type}", self)
             self.room_controller.attach_object(new_obj)
-            self.objects.append(new_obj)
+            self.objects[object_name] = new_obj
             return new_obj
 
-    def update_object(self, object_name, data):
+    def update_object(self, object_name, data, delta=False):
         """
         Update the object with new data
+        :param delta: The data only holds the changed keys (protocol v2)
         """
         # Check if we've already created the object
-        if object_name not in [obj.object_name for obj in self.objects]:
-            self.attach_object(object_name, data["type"])
-        for obj in self.objects:
-            if obj.object_name == object_name:
-                obj.update(data)
-                return True
-        return False
+        obj = self.objects.get(object_name)
+        if obj is None:
+            if "type" not in data:  # A delta for an object we haven't seen, only a full snapshot can create it
+                return False
+            obj = self.attach_object(object_name, data["type"])
+        if obj is None:
+            return False
+        if delta:
+            obj.apply_delta(data)
+        else:
+            obj.update(data)
+        return True
 
     def parse_uplink(self, data):
         """
         Parses the uplink data from the satellite
+        Version 1 uplinks carry every object in full, version 2 uplinks carry a sequence number and either a full
+        snapshot ("full": true) or only the changed keys of the changed objects
+        :return: For version 2 uplinks, {"seq": last applied sequence number, "resync": True if a full snapshot is
+         needed because an uplink was missed, an object is unknown or the last snapshot is too old}
         """
         if data["name"] != self.name:
             logging.warning(f"Received uplink data from {data['name']} but expected {self.name}")
             return
+        version = data.get("version", 1)
+        if version == 1:
+            self.last_seen = time.time()
+            self.ip = str(data["current_ip"]).strip("'")
+            self._save_last_seen()
+            for object_name, object_data in data["objects"].items():
+                if not self.update_object(object_name, object_data):
+                    logging.warning(f"Received data for object {object_name} but it does not exist")
+            return
+
+        # Checked before anything is applied so a malformed uplink is answered with a resync rather than an error
+        # and never leaves the objects partly updated
+        if (problem := self._validate_v2(data)) is not None:
+            logging.warning(f"Satellite {self.name} sent a malformed uplink ({problem}), requesting a resync")
+            return {"seq": self.uplink_seq, "resync": True}
         self.last_seen = time.time()
-        print(data)
+        if data.get("current_ip") is not None:
+            self.ip = str(data["current_ip"]).strip("'")
+        self._save_last_seen()
+
+        seq = data["seq"]
+        if data.get("full", False):
+            self.last_full_snapshot = self.last_seen
+        elif self.uplink_seq is None or seq != self.uplink_seq + 1:
+            # A gap means an uplink was missed and a lower number means the satellite restarted its count, either
+            # way the deltas no longer line up with what we hold
+            logging.info(f"Satellite {self.name} sent uplink {seq} after {self.uplink_seq}, requesting a resync")
+            return {"seq": self.uplink_seq, "resync": True}
+
+        resync = False
         for object_name, object_data in data["objects"].items():
-            if not self.update_object(object_name, object_data):
+            if not self.update_object(object_name, object_data, delta=not data.get("full", False)):
                 logging.warning(f"Received data for object {object_name} but it does not exist")
-        self.ip = data["current_ip"]
-        self.ip = str(self.ip).strip("'")
+                resync = True
+        self.uplink_seq = seq
+        return {"seq": self.uplink_seq, "resync": resync or self._snapshot_stale()}
+
+    def _snapshot_stale(self):
+        return self.last_full_snapshot < time.time() - self.full_snapshot_interval
+
+    @staticmethod
+    def _validate_v2(data):
+        """
+        Check the structure of a version 2 uplink
+        :return: A description of the first problem found or None if the uplink is well formed
+        """
+        if data.get("version") != 2:
+            return f"unsupported version {data.get('version')!r}"
+        if not isinstance(data.get("seq"), int) or isinstance(data["seq"], bool):
+            return "seq is not an integer"
+        full = data.get("full", False)
+        if not isinstance(full, bool):
+            return "full is not a boolean"
+        if not isinstance(data.get("objects"), dict):
+            return "objects is not a dict"
+        for object_name, object_data in data["objects"].items():
+            if not isinstance(object_data, dict):
+                return f"{object_name} is not a dict"
+            if full and not all(key in object_data for key in ("type", "data", "health")):
+                return f"{object_name} is missing its type, data or health in a full snapshot"
+            if not isinstance(object_data.get("data", {}), dict):
+                return f"{object_name} data is not a dict"
+            if "health" in object_data and not isinstance(object_data["health"], dict):
+                return f"{object_name} health is not a dict"
+            if not isinstance(object_data.get("removed", []), list):
+                return f"{object_name} removed is not a list"
+        return None
+
+    def _save_last_seen(self):
+        # last_seen is only needed across restarts, so it isn't written on every uplink
+        if self.last_seen - self.last_seen_saved < self.last_seen_interval:
+            return
+        self.last_seen_saved = self.last_seen
         self.room_controller.database.run("UPDATE satellites SET last_seen = ? WHERE name = ?",
                                           (self.last_seen, self.name))
 
@@ -167,26 +253,25 @@ class Satellite:
         Parses the event data from the satellite
         """
         try:
-            print(data)
             # logging.info(f"Received event {data['event']} from {data['object']}")
             if data["name"] != self.name:
                 logging.warning(f"Received event data from {data['name']} but expected {self.name}")
                 return
             self.last_seen = time.time()
-            for obj in self.objects:
-                if obj.object_name == data["object"]:
-                    if data["event"] == "state_change":
-                        for key, value in data["args"][0].items():
-                            obj.set_value(key, value)
-                    else:
-                        # logging.info(f"Received event {data['event']} from {data['object']}")
-                        if data["args"] is None:
-                            data["args"] = []
-                        if data["kwargs"] is None:
-                            data["kwargs"] = {}
-                        obj.emit_event(data["event"], *data["args"], dont_repeat=True, **data["kwargs"])
-                    return
-            logging.warning(f"Received event data for object {data['object']} but it does not exist")
+            obj = self.objects.get(data["object"])
+            if obj is None:
+                logging.warning(f"Received event data for object {data['object']} but it does not exist")
+                return
+            if data["event"] == "state_change":
+                for key, value in data["args"][0].items():
+                    obj.set_value(key, value)
+            else:
+                # logging.info(f"Received event {data['event']} from {data['object']}")
+                if data["args"] is None:
+                    data["args"] = []
+                if data["kwargs"] is None:
+                    data["kwargs"] = {}
+                obj.emit_event(data["event"], *data["args"], dont_repeat=True, **data["kwargs"])
         except Exception as e:
             logging.error(f"Error parsing event data: {e}")
             logging.exception(e)
@@ -213,6 +298,8 @@ class Satellite:
     async def link_cycle(self):
         """
         Cycle through the downlink queue and send the events to the satellite
+        Every event queued within batch_window of the first is sent with it, so a scene that touches several of the
+        satellite's objects costs one request
         """
         logging.info(f"Starting link cycle for {self.name}")
         while True:
@@ -220,16 +307,27 @@ class Satellite:
                 await asyncio.sleep(10)
                 continue
             try:
-                event = await self.downlink_queue.get()
-                # logging.info(f"Sending downlink event {event[1]} to {self.name}")
-                await self._downlink_event(*event)
+                batch = [await self.downlink_queue.get()]
+                await asyncio.sleep(self.batch_window)
+                while len(batch) < self.max_batch and not self.downlink_queue.empty():
+                    batch.append(self.downlink_queue.get_nowait())
+                # logging.info(f"Sending {len(batch)} downlink events to {self.name}")
+                await self._downlink_batch(batch)
             except asyncio.CancelledError:
                 logging.info(f"Stopping link cycle for {self.name}")
+                if self.session is not None:
+                    await self.session.close()
                 break
             except Exception as e:
                 logging.error(f"Error sending downlink event to {self.name}: {e}")
                 logging.exception(e)
 
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            session_timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5)
+            self.session = aiohttp.ClientSession(timeout=session_timeout)
+        return self.session
+
     def send_downlink(self, object_ref, event_name, *args, **kwargs):
         """
         Add an event to the downlink queue
@@ -240,35 +338,61 @@ class Satellite:
         except asyncio.QueueFull:
             logging.warning(f"Downlink queue full for {self.name}")
 
-    async def _downlink_event(self, object_ref, event_name, *args, **kwargs):
+    @staticmethod
+    def _event_data(object_ref, event_name, args, kwargs):
+        """Build the wire format of one downlink event"""
+        # Clean up the kwargs
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+        return {
+            "object": object_ref.name(),
+            "event": event_name,
+            "args": list(args),
+            "kwargs": kwargs
+        }
+
+    async def _downlink_batch(self, batch):
         """
-        Send an event to the satellite
+        Send a batch of events to the satellite, in one POST to /event_batch if the satellite has it
+        otherwise one POST to /event per event
         """
         if not self.online:
             logging.warning(f"Cannot send event to {self.name} because it is offline")
             return
-        # Clean up the args and kwargs
-        args = [arg for arg in args if arg is not None]
-        kwargs = {key: value for key, value in kwargs.items() if value is not None}
-        # If args or kwargs are empty, set them to None
-        args = args if args != [[], {}] else []
-        # print(args)
-        kwargs = kwargs if len(kwargs) > 0 else {}
+        if self.ip is None:
+            logging.warning(f"Cannot send event to {self.name} because it does not have an IP address")
+            return
+        events = [self._event_data(*event) for event in batch]
+        if len(events) > 1 and self.batch_supported:
+            data = {
+                "name": self.name,
+                "current_ip": self.ip,
+                "events": events,
+                "auth": self.auth
+            }
+            async with self._get_session().post(f"http://{self.ip}:47670/event_batch", json=data) as response:
+                if response.status == 200:
+                    return
+                if response.status != 404:
+                    logging.warning(f"Failed to send {len(events)} events to {self.name} with status "
+                                    f"{response.status}: {await response.text()}")
+                    return
+            logging.info(f"Satellite {self.name} doesn't support batched events, sending them individually")
+            self.batch_supported = False
+        for event in events:
+            await self._downlink_event(event)
+
+    async def _downlink_event(self, event):
+        """
+        Send an event to the satellite
+        """
         data = {
             "name": self.name,
             "current_ip": self.ip,
-            "object": object_ref.name(),
-            "event": event_name,
-            "args": args[0],
-            "kwargs": kwargs,
+            **event,
             "auth": self.auth
         }
-        # logging.info(f"Sending event {event_name} to {self.name} @ {self.ip}:47670")
-        if self.ip is None:
-            logging.warning(f"Cannot send event to {self.name} because it does not have an IP address")
-            return
-        session_timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5)
-        async with request("POST", f"http://{self.ip}:47670/event", json=data, timeout=session_timeout) as response:
+        # logging.info(f"Sending event {event['event']} to {self.name} @ {self.ip}:47670")
+        async with self._get_session().post(f"http://{self.ip}:47670/event", json=data) as response:
             if response.status != 200:
                 logging.warning(f"Failed to send event to {self.name} with status {response.status}: {await response.text()}")
 
@@ -292,6 +416,8 @@ class SatelliteInterface(RoomModule):
         # POST - /downlink - To receive commands from the server
         # GET  - /uplink   - For the server to poll the satellite for data
         # POST - /event    - For the server to send events to the satellite
+        # POST - /event_batch - For the server to send several events in one request (optional)
+        #   {"name": ..., "current_ip": ..., "events": [{"object", "event", "args", "kwargs"}, ...], "auth": ...}
 
         self.runner = web.AppRunner(self.app, access_log=None)
         self.webserver_address = get_host_names()
@@ -329,6 +455,19 @@ class SatelliteInterface(RoomModule):
         await self.start_satellites()
         return site
 
+    def authenticate(self, payload):
+        """
+        Find the satellite a payload came from, satellites are looked up by name and the token is compared in
+        constant time so neither the fleet size nor the token leaks through how long a request takes
+        :return: The satellite or None if the name is unknown or the token doesn't match
+        """
+        satellite = self.satellites.get(payload.get("name"))
+        if satellite is None or satellite.auth is None:
+            return None
+        if not hmac.compare_digest(str(satellite.auth).encode(), str(payload.get("auth", "")).encode()):
+            return None
+        return satellite
+
     async def uplink_data(self, request):
         """
         Called by a satellite to send data to the server (e.g. sensor data, state changes)
@@ -351,14 +490,19 @@ class SatelliteInterface(RoomModule):
             },
             "auth": "Authentication token"
         }
+        Version 2 satellites add "version": 2, "seq": sequence number (incremented by one per uplink) and
+        "full": true for a full snapshot, otherwise each object only holds the keys that changed, health only if it
+        changed and "removed": [keys] for deleted keys (type may be left out for objects already sent)
+        They are answered with {"seq": last applied sequence number, "resync": Boolean}, on resync the satellite
+        should send a full snapshot next
         """
         logging.info("Received uplink data")
         payload = await request.json()
-        for satellite in self.satellites.values():
-            if satellite.auth == payload["auth"] and satellite.name == payload["name"]:
-                satellite.parse_uplink(payload)
-                return web.Response(status=200)
-        return web.Response(status=401)
+        if (satellite := self.authenticate(payload)) is None:
+            return web.Response(status=401)
+        if (result := satellite.parse_uplink(payload)) is not None:
+            return web.json_response(result)
+        return web.Response(status=200)
 
     async def uplink_event(self, request):
         """
@@ -376,11 +520,10 @@ class SatelliteInterface(RoomModule):
         """
         logging.info("Received uplink event")
         payload = await request.json()
-        for satellite in self.satellites.values():
-            if satellite.name == payload["name"]:
-                satellite.parse_event(payload)
-            return web.Response(status=200)
-        return web.Response(status=401)
+        if (satellite := self.authenticate(payload)) is None:
+            return web.Response(status=401)
+        satellite.parse_event(payload)
+        return web.Response(status=200)
 
     async def downlink_poll(self, request):
         """
@@ -393,7 +536,6 @@ class SatelliteInterface(RoomModule):
         """
         logging.info("Received downlink poll request")
         payload = await request.json()
-        for satellite in self.satellites.values():
-            if satellite.auth == payload["auth"]:
-                return web.json_response(satellite.generate_payload())
-        return web.Response(status=401)
+        if (satellite := self.authenticate(payload)) is None:
+            return web.Response(status=401)
+        return web.json_response(satellite.generate_payload())
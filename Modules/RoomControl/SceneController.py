@@ -1,14 +1,18 @@
+import json
+import threading
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import ConcurrentDatabase
-from Modules.RoomControl.API.datagrams import APIMessageRX
-from Modules.RoomControl.Decorators import background
+from Modules.RoomControl.API.datagrams import APIMessageRX, APIMessageTX
 
 from loguru import logger as logging
 
 from Modules.RoomControl.SceneTriggerTypes.SceneTrigger import SceneTrigger
+from Modules.RoomControl.SceneTriggerTypes.TriggerScheduler import TriggerScheduler
 from Modules.RoomModule import RoomModule
+from Modules.StartupProfiler import startup_profiler
 import os
 
 # Auto import all files in the SceneTriggerTypes directory
@@ -16,7 +20,57 @@ for module in os.listdir("Modules/RoomControl/SceneTriggerTypes"):
     if module.endswith(".py") and module != "__init__.py":
         module_name = module.replace(".py", "")
         logging.info(f"Importing {module_name}")
+        import_start = time.perf_counter()
         __import__(f"Modules.RoomControl.SceneTriggerTypes.{module_name}", fromlist=[module_name])
+        startup_profiler.record_import(f"Modules.RoomControl.SceneTriggerTypes.{module_name}",
+                                       time.perf_counter() - import_start)
+
+
+class ScenePlan:
+    """
+    A scene compiled into the actions to apply to each device with the values already converted to their types,
+    device references are resolved once and reused for every execution of the scene
+    """
+
+    def __init__(self, scene_data):
+        """
+        :param scene_data: The scene json (or already decoded dict) in the format {device_name: {action: value}}
+        """
+        self.actions = {}  # type: dict[str, list[tuple[str, object]]]
+        self.devices = {}  # type: dict[str, RoomObject]
+        if isinstance(scene_data, (str, bytes, bytearray)):
+            try:
+                scene_data = json.loads(scene_data) if scene_data else {}
+            except json.JSONDecodeError as e:
+                logging.error(f"ScenePlan: Failed to decode scene data: {e}")
+                scene_data = {}
+        for device_name, device_command in scene_data.items():
+            if not isinstance(device_command, dict):
+                logging.warning(f"ScenePlan: Ignoring invalid command for {device_name}: {device_command}")
+                continue
+            self.actions[device_name] = [(action, self._parse_value(value)) for action, value in device_command.items()]
+
+    @staticmethod
+    def _parse_value(value):
+        if value == "true" or value == "True":
+            return True
+        if value == "false" or value == "False":
+            return False
+        return value
+
+    def resolve(self, room_controller):
+        """
+        Look up any devices that haven't been found yet
+        :return: The devices this plan acts on keyed by name
+        """
+        for device_name in self.actions.keys() - self.devices.keys():
+            device = room_controller.get_object(device_name, create_if_not_found=False)
+            if device is not None:
+                self.devices[device_name] = device
+        return self.devices
+
+    def missing_devices(self):
+        return [device_name for device_name in self.actions if device_name not in self.devices]
 
 
 class SceneController(RoomModule):
@@ -30,7 +84,17 @@ class SceneController(RoomModule):
         self.room_controller = room_controller
 
         self.scenes = {}  # type: dict[str, dict, bool]
+        self.scene_plans = {}  # type: dict[str, ScenePlan]
+        self.scene_runs = {}  # type: dict[str, dict] # The result of the last execution of each scene
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="SceneController")
         self.triggers = {}  # type: dict[str, SceneTrigger]
+        self.scene_triggers = {}  # type: dict[str, set] # The trigger ids belonging to each scene
+        self.next_trigger_id = 1
+        self.scene_lock = threading.Lock()  # Serializes edits to the scenes and triggers
+        self.action_summaries = {}  # type: dict[str, str] # Cached results of action_to_str
+        self.scenes_payload = None  # type: bytes | None # The serialized get_scenes response
+        self.summary_generation = None  # The room controller's object generation the summaries were built against
+        self.trigger_scheduler = TriggerScheduler()  # Runs all the time based triggers
         self.available_triggers = []
         self.trigger_tasks = []
         self._load_scenes()
@@ -47,8 +111,17 @@ class SceneController(RoomModule):
             logging.error(f"Invalid trigger type {trigger_type}")
             return
         self.triggers[trigger_id] = trigger
+        self.scene_triggers.setdefault(scene_id, set()).add(trigger_id)
         return trigger
 
+    def _remove_trigger(self, trigger_id):
+        """Stop a trigger and remove it from the in memory maps"""
+        trigger = self.triggers.pop(trigger_id, None)
+        if trigger is None:
+            return
+        trigger.stop()
+        self.scene_triggers.get(trigger.scene_id, set()).discard(trigger_id)
+
     def _init_database(self):
         self.database.create_table("scenes", {"scene_id": "TEXT UNIQUE PRIMARY KEY", "scene_name": "TEXT NOT NULL",
                                               "scene_data": "TEXT"})
@@ -77,46 +150,63 @@ class SceneController(RoomModule):
         for scene in self.scenes:
             del scene
         self.scenes = {}
+        self.scene_plans = {}
         table = self.database.run("SELECT * FROM scenes")
         scenes = table.fetchall()
         for scene in scenes:
-            self.scenes[scene[0]] = {
-                "name": scene[1],
-                "data": scene[2],
-                "description": scene[3],
-            }
+            self._set_scene(scene[0], scene[1], scene[2], scene[3])
+
+    def _set_scene(self, scene_id, name, data, description):
+        """Store a scene in memory and compile its plan"""
+        self._invalidate_scene(scene_id)
+        self.scenes[scene_id] = {
+            "name": name,
+            "data": data,
+            "description": description,
+        }
+        self.scene_plans[scene_id] = ScenePlan(data)
+        self.scene_plans[scene_id].resolve(self.room_controller)
 
     def _update_triggers(self, scene_id, triggers):
-        db_triggers = self.database.run("SELECT * FROM scene_triggers WHERE scene_id=?", (scene_id,))
-        db_triggers = db_triggers.fetchall()
-        for db_trigger in db_triggers:
-            if db_trigger[1] not in [trigger["trigger_id"] for trigger in triggers]:
-                logging.info(f"Deleting trigger {db_trigger[1]} from scene {scene_id}")
-                # Delete the trigger
-                self.database.run("DELETE FROM scene_triggers WHERE trigger_id=?", (db_trigger[1],))
+        """
+        Apply the triggers sent by the API to a scene, only the triggers that were added, changed or removed are
+        written to the database and rebuilt
+        """
+        # Trigger ids are integers in the database but arrive from the API as strings
+        current = {str(trigger_id): trigger_id for trigger_id in self.scene_triggers.get(scene_id, set())}
+        kept = {str(trigger["trigger_id"]) for trigger in triggers}
+        for key, trigger_id in current.items():
+            if key not in kept:
+                logging.info(f"Deleting trigger {trigger_id} from scene {scene_id}")
+                self.database.run("DELETE FROM scene_triggers WHERE trigger_id=?", (trigger_id,))
+                self._remove_trigger(trigger_id)
         for trigger in triggers:
-            if trigger["trigger_id"] == "0":
+            values = (trigger["trigger_type"], trigger["trigger_subtype"], trigger["trigger_value"], trigger["enabled"])
+            key = str(trigger["trigger_id"])
+            if key == "0":
                 logging.info(f"Adding new trigger to scene {scene_id}")
-                # Calculate the next trigger_id
-                new_id = self.database.run("SELECT MAX(trigger_id) FROM scene_triggers").fetchone()[0]
-                if new_id is None:
-                    new_id = 1
-                else:
-                    new_id += 1
-                # Add a new trigger
+                trigger_id = self.next_trigger_id
+                self.next_trigger_id += 1
                 self.database.run("INSERT INTO scene_triggers "
                                   "(scene_id, trigger_id, trigger_type, trigger_subtype, "
                                   "trigger_value, active) VALUES (?, ?, ?, ?, ?, ?)",
-                                  (scene_id, new_id,
-                                   trigger["trigger_type"], trigger["trigger_subtype"],
-                                   trigger["trigger_value"], trigger["enabled"]))
-            else:
-                # Update the trigger
-                logging.info(f"Updating trigger {trigger['trigger_id']} for scene {scene_id}")
+                                  (scene_id, trigger_id, *values))
+            elif key in current:
+                trigger_id = current[key]
+                existing = self.triggers[trigger_id].info()
+                if values == (existing["trigger_type"], existing["trigger_subtype"], existing["trigger_value"],
+                              existing["enabled"]):
+                    continue  # Unchanged, leave it scheduled
+                logging.info(f"Updating trigger {trigger_id} for scene {scene_id}")
                 self.database.run("UPDATE scene_triggers SET trigger_type=?, trigger_subtype=?, trigger_value=?, "
-                                  "active=? WHERE trigger_id=?",
-                                  (trigger["trigger_type"], trigger["trigger_subtype"], trigger["trigger_value"],
-                                   trigger["enabled"], trigger["trigger_id"]))
+                                  "active=? WHERE trigger_id=?", (*values, trigger_id))
+                self._remove_trigger(trigger_id)
+            else:
+                logging.warning(f"Ignoring unknown trigger {key} for scene {scene_id}")
+                continue
+            new_trigger = self._create_trigger(scene_id, trigger_id, *values)
+            if new_trigger is not None:
+                new_trigger.run()
 
     def add_scene(self, json_payload):
         """Called by the API to add a scene"""
@@ -138,6 +228,7 @@ class SceneController(RoomModule):
 
     def update_scene(self, scene_id, json_payload, new_scene_override=False):
         """Called by the API to edit a scene"""
+        scene_id = str(scene_id)  # Scene ids are stored as text
         try:
             if scene_id not in self.scenes and not new_scene_override:
                 return "Scene does not exist"
@@ -147,14 +238,14 @@ class SceneController(RoomModule):
             scene_name = json_payload.get("scene_name", "")
             scene_data = APIMessageRX(scene_data).__str__()
             logging.info(f"Updating scene {scene_id} with data {scene_data} and name {scene_name}")
-            # Update the scene data
-            self.database.run("UPDATE scenes SET scene_data=?, scene_name=? WHERE scene_id=?",
-                              (scene_data, scene_name, scene_id))
-            # Update the triggers
-            self._update_triggers(scene_id, triggers)
-            # Reload the scenes
-            self._load_scenes()
-            self._load_triggers()
+            with self.scene_lock:
+                # Update the scene data
+                self.database.run("UPDATE scenes SET scene_data=?, scene_name=? WHERE scene_id=?",
+                                  (scene_data, scene_name, scene_id))
+                description = self.scenes[scene_id]["description"] if scene_id in self.scenes else None
+                self._set_scene(scene_id, scene_name, scene_data, description)
+                # Update the triggers
+                self._update_triggers(scene_id, triggers)
             return "success"
         except Exception as e:
             logging.error(f"Error updating scene: {e}")
@@ -163,30 +254,79 @@ class SceneController(RoomModule):
 
     def delete_scene(self, scene_id):
         """Called by the API to delete a scene"""
+        scene_id = str(scene_id)
         if scene_id not in self.scenes:
             return "Scene does not exist"
-        del self.scenes[scene_id]
-        # Remove all triggers associated with the scene
-        self.database.run("DELETE FROM scene_triggers WHERE scene_id=?", (scene_id,))
-        self.database.run("DELETE FROM scenes WHERE scene_id=?", (scene_id,))
+        with self.scene_lock:
+            del self.scenes[scene_id]
+            self.scene_plans.pop(scene_id, None)
+            self._invalidate_scene(scene_id)
+            # Remove all triggers associated with the scene
+            for trigger_id in list(self.scene_triggers.pop(scene_id, set())):
+                self._remove_trigger(trigger_id)
+            self.database.run("DELETE FROM scene_triggers WHERE scene_id=?", (scene_id,))
+            self.database.run("DELETE FROM scenes WHERE scene_id=?", (scene_id,))
         logging.info(f"Deleted scene {scene_id}")
-        self._load_scenes()
         return "success"
 
     def execute_scene(self, scene_id):
         if scene_id not in self.scenes:
             logging.error("Scene {} does not exist".format(scene_id))
             return False
-        scene_data = self.scenes[scene_id]["data"]
-        command = APIMessageRX(scene_data)
         logging.info("Executing scene {}".format(scene_id))
-        self.run_scene(command)
+        self.run_plan(self.scene_plans[scene_id], scene_id)
         return "success"
 
     def run_scene(self, command):
-        for device in self.room_controller.room_objects:
-            if hasattr(command, device.object_name):
-                self.execute_commands(device, command)
+        """Runs a scene that isn't saved (e.g. to test a scene from the API)"""
+        self.run_plan(ScenePlan(command), "test")
+
+    def run_plan(self, plan, scene_id):
+        """
+        Dispatches the actions for every device in the plan concurrently, the result of the run is recorded in
+        scene_runs once every device has finished
+        """
+        started = time.perf_counter()
+        pending = {}
+        for device_name, device in plan.resolve(self.room_controller).items():
+            pending[device_name] = self.executor.submit(self.execute_commands, device, plan.actions[device_name])
+        missing = plan.missing_devices()
+        if not pending:
+            self._record_scene_run(scene_id, started, pending, missing)
+            return
+        # The run is recorded by whichever action finishes last, so no thread is left waiting on the actions
+        remaining = len(pending)
+        remaining_lock = threading.Lock()
+
+        def action_done(_):
+            nonlocal remaining
+            with remaining_lock:
+                remaining -= 1
+                finished = remaining == 0
+            if finished:
+                self._record_scene_run(scene_id, started, pending, missing)
+
+        for future in pending.values():
+            future.add_done_callback(action_done)
+
+    def _invalidate_scene(self, scene_id):
+        """Drop the cached summary of a scene and the cached scene list, must be called whenever a scene changes"""
+        self.action_summaries.pop(scene_id, None)
+        self.scenes_payload = None
+
+    def invalidate_summaries(self):
+        """Called when the devices or their names change, every summary will be rebuilt on the next request"""
+        with self.scene_lock:
+            self.action_summaries = {}
+            self.scenes_payload = None
+
+    def _check_summary_generation(self):
+        """Expire the cached summaries if objects have been attached to the room controller since they were built"""
+        generation = self.room_controller.object_generation
+        if generation != self.summary_generation:
+            self.action_summaries = {}
+            self.scenes_payload = None
+            self.summary_generation = generation
 
     def get_scenes(self):
         """Returns a dictionary of all scenes, including their triggers"""
@@ -202,6 +342,21 @@ class SceneController(RoomModule):
             }
         return scenes
 
+    def get_scenes_payload(self):
+        """
+        Returns the get_scenes API response already serialized, it is only rebuilt after a scene or device changes
+        A cached payload is returned without taking scene_lock, it is only ever replaced so it can be read as is
+        :return: The response body as bytes
+        """
+        payload = self.scenes_payload
+        if payload is not None and self.summary_generation == self.room_controller.object_generation:
+            return payload
+        with self.scene_lock:
+            self._check_summary_generation()
+            if self.scenes_payload is None:
+                self.scenes_payload = APIMessageTX(result=self.get_scenes()).__str__().encode("utf-8")
+            return self.scenes_payload
+
     def get_default_triggers(self):
         """Returns a list of default triggers"""
         triggers = []
@@ -217,11 +372,7 @@ class SceneController(RoomModule):
 
     def get_triggers(self, scene_id):
         """Returns a list of triggers for the specified scene"""
-        triggers = []
-        for trigger_id, trigger in self.triggers.items():
-            if trigger.scene_id == scene_id:
-                triggers.append(trigger.info())
-        return triggers
+        return [self.triggers[trigger_id].info() for trigger_id in self.scene_triggers.get(scene_id, ())]
 
     def execute_get(self, value, target):
         match value:
@@ -231,6 +382,8 @@ class SceneController(RoomModule):
                 return self.get_default_triggers()
             case "triggers":
                 return self.get_triggers(target)
+            case "runs":
+                return self.scene_runs
             case "scene":
                 pass
             case _:
@@ -252,44 +405,75 @@ class SceneController(RoomModule):
     def _load_triggers(self):
         logging.info("SceneController: Loading triggers...")
         for trigger in self.triggers.values():
-            trigger.stopped = True
-            del trigger
+            trigger.stop()
         self.triggers = {}
+        self.scene_triggers = {}
         table = self.database.run("SELECT * FROM scene_triggers")
         triggers = table.fetchall()
         for trigger in triggers:
             self._create_trigger(trigger[0], trigger[1], trigger[2], trigger[3], trigger[4], trigger[5])
+        # New trigger ids are handed out from memory instead of querying the table for every new trigger
+        self.next_trigger_id = max((trigger[1] for trigger in triggers if isinstance(trigger[1], int)), default=0) + 1
         for trigger in self.triggers.values():
             trigger.run()
 
-    @background
-    def execute_commands(self, device, command):
+    def execute_commands(self, device, actions):
+        """
+        Applies the actions to the device
+        :return: A list of the errors encountered, empty if every action was applied
+        """
         logging.info(f"Executing scene command for device {device.name()}")
-        device_command = getattr(command, device.name())
-        for action, value in device_command.items():
+        errors = []
+        for action, value in actions:
             try:
-                if value == "true" or value == "True":
-                    value = True
-                if value == "false" or value == "False":
-                    value = False
                 # Dynamically check if the device supports the action and set the value
                 if hasattr(device, action):
                     setattr(device, action, value)
                 else:
                     logging.warning(f"Device {device.name()} does not support action {action}")
+                    errors.append(f"Unsupported action {action}")
             except Exception as e:
                 logging.error(f"Error executing scene command: {e}")
                 logging.exception(e)
+                errors.append(f"{action}: {e}")
+        return errors
+
+    def _record_scene_run(self, scene_id, started, pending, missing):
+        devices = {}
+        for device_name, future in pending.items():
+            if future.exception() is not None:
+                errors = [str(future.exception())]
+            else:
+                errors = future.result()
+            devices[device_name] = {"success": len(errors) == 0, "errors": errors}
+        for device_name in missing:
+            devices[device_name] = {"success": False, "errors": ["Device not found"]}
+        latency = time.perf_counter() - started
+        self.scene_runs[scene_id] = {
+            "finished": time.time(),
+            "latency": round(latency, 4),
+            "success": all(device["success"] for device in devices.values()),
+            "devices": devices,
+        }
+        logging.info(f"Scene {scene_id} executed on {len(pending)} devices in {latency * 1000:.1f}ms "
+                     f"({sum(not device['success'] for device in devices.values())} failed)")
 
     def action_to_str(self, scene_id):
         """
-        Returns human readable discription of the actions of the scene
+        Returns human readable discription of the actions of the scene, the description is cached until the scene or
+        the room's devices change
         Example: Sets [device] [setting] to [value]
         """
-        actions = []
         if scene_id not in self.scenes:
             logging.error("Scene {} does not exist".format(scene_id))
             return f"Scene {scene_id} does not exist"
+        self._check_summary_generation()
+        if scene_id not in self.action_summaries:
+            self.action_summaries[scene_id] = self._build_action_summary(scene_id)
+        return self.action_summaries[scene_id]
+
+    def _build_action_summary(self, scene_id):
+        actions = []
         scene_data = self.scenes[scene_id]["data"]
         command = APIMessageRX(scene_data)
         for device in self.room_controller.room_objects:
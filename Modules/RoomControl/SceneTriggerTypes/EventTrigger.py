@@ -0,0 +1,48 @@
+from loguru import logger as logging
+
+from Modules.EventBus import event_bus
+from Modules.RoomControl.SceneTriggerTypes.SceneTrigger import SceneTrigger
+
+
+class EventTrigger(SceneTrigger):
+    """
+    Runs a scene when a room object emits an event
+    The trigger subtype is the name of the object and the trigger value is the name of the event, optionally followed
+    by =value to only trigger when the first argument of the event matches (e.g. on_occupied_update=True)
+    """
+
+    default_trigger_subtype = ""
+    default_trigger_value = "on_occupied_update=True"
+
+    def __init__(self, scene_controller, scene_id, trigger_id, trigger_subtype, trigger_value, enabled):
+        super().__init__(scene_controller, scene_id, trigger_id, trigger_subtype, trigger_value, enabled)
+        logging.info(f"Initializing EventTrigger[{self.trigger_id}] for Scene ({scene_id})")
+        self.subscription = None
+        event_name, _, match_value = (trigger_value or "").partition("=")
+        self.event_name = event_name.strip()
+        self.match_value = match_value.strip() or None
+
+    def run(self):
+        if not self.trigger_subtype or not self.event_name:
+            logging.error(f"EventTrigger[{self.trigger_id}] for Scene ({self.scene_id}) has no object or event")
+            return
+        self.subscription = event_bus.subscribe(self.trigger_subtype, self.event_name, self._event)
+        logging.info(f"EventTrigger[{self.trigger_id}] for Scene ({self.scene_id}) is waiting for "
+                     f"{self.trigger_subtype}.{self.event_name}")
+
+    def stop(self):
+        super().stop()
+        if self.subscription is not None:
+            event_bus.unsubscribe(self.subscription)
+            self.subscription = None
+        logging.info(f"EventTrigger[{self.trigger_id}] for Scene ({self.scene_id}) has been stopped")
+
+    def _event(self, *args, **kwargs):
+        if self.stopped or not self.enabled:
+            return
+        if self.match_value is not None and (not args or str(args[0]).lower() != self.match_value.lower()):
+            return
+        logging.info(f"EventTrigger[{self.trigger_id}] for Scene ({self.scene_id}) fired on "
+                     f"{self.trigger_subtype}.{self.event_name}")
+        # Scene execution is dispatched to the scene controller's executor so the emitting thread isn't held up
+        self.scene_controller.execute_scene(self.scene_id)
@@ -14,6 +14,7 @@ class IntervalTrigger(SceneTrigger):
     def __init__(self, scene_controller, scene_id, trigger_id, trigger_subtype, trigger_value, enabled):
         super().__init__(scene_controller, scene_id, trigger_id, trigger_subtype, trigger_value, enabled)
         logging.info(f"Initializing IntervalTrigger[{self.trigger_id}] for Scene ({scene_id})")
+        self.scheduled = None  # The pending call in the scene controller's trigger scheduler
 
     def _prep_interval_trigger(self, interval_type: str, interval_value: str):
         """
@@ -77,17 +78,30 @@ class IntervalTrigger(SceneTrigger):
         # Return the time delta in seconds
         return time_delta.total_seconds()
 
-    def exec(self):
-        while not self.stopped:
-            wait = self._prep_interval_trigger(self.trigger_subtype, self.trigger_value)
-            logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id}) will trigger in {wait} seconds")
-            time.sleep(wait)  # Sleep this trigger until the target time arrives
-            if self.enabled and not self.stopped:
-                logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id}) has elapsed")
-                self.scene_controller.execute_scene(self.scene_id)
-            else:
-                logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id})"
-                             f" elapsed but trigger was disabled")
+    def run(self):
+        self._schedule_next()
+
+    def stop(self):
+        super().stop()
+        if self.scheduled is not None:
+            self.scene_controller.trigger_scheduler.cancel(self.scheduled)
+            self.scheduled = None
         logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id}) has been stopped")
 
+    def _schedule_next(self):
+        wait = self._prep_interval_trigger(self.trigger_subtype, self.trigger_value)
+        if wait is None:  # The trigger is misconfigured, the reason has already been logged
+            return
+        logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id}) will trigger in {wait} seconds")
+        self.scheduled = self.scene_controller.trigger_scheduler.schedule(time.time() + wait, self._elapsed)
 
+    def _elapsed(self):
+        if self.stopped:
+            return
+        if self.enabled:
+            logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id}) has elapsed")
+            self.scene_controller.execute_scene(self.scene_id)
+        else:
+            logging.info(f"TimerTrigger[{self.trigger_id}] for Scene ({self.scene_id})"
+                         f" elapsed but trigger was disabled")
+        self._schedule_next()
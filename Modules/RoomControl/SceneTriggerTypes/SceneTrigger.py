@@ -26,6 +26,10 @@ class SceneTrigger:
     def run(self):
         self.exec()
 
+    def stop(self):
+        """Called when the trigger is removed or reloaded, the trigger must not fire after this"""
+        self.stopped = True
+
     def info(self):
         return {
             "trigger_type": self.__class__.__name__,
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import threading
+import time
+
+from loguru import logger as logging
+
+from Modules.RoomControl.Decorators import background
+
+
+class ScheduledCall:
+    """A callback waiting in the TriggerScheduler, kept so that the caller can cancel it"""
+
+    __slots__ = ("deadline", "callback", "cancelled", "queued")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.queued = True  # Still in the heap, cleared when the scheduler pops it
+
+
+class TriggerScheduler:
+    """
+    Runs the callbacks of every time based trigger from a single thread
+    Pending callbacks are kept in a heap ordered by deadline, cancelling only marks the entry so it is O(1) and the
+    entry is discarded when it reaches the top of the heap (or when cancelled entries make up half the heap)
+    """
+
+    max_wait = 60  # Re-check the wall clock at least this often so clock changes (e.g. NTP sync on boot) are noticed
+
+    def __init__(self):
+        self._heap = []  # type: list[tuple[float, int, ScheduledCall]]
+        self._sequence = itertools.count()  # Breaks ties between calls with the same deadline
+        self._cancelled = 0
+        self._condition = threading.Condition()
+        self._run()
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def schedule(self, deadline, callback):
+        """
+        Schedule a callback to be called at a wall clock time
+        :param deadline: The time.time() to call the callback at
+        :param callback: The function to call, it is called on the scheduler thread so it should not block
+        :return: The ScheduledCall that can be passed to cancel
+        """
+        call = ScheduledCall(deadline, callback)
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), call))
+            if self._heap[0][2] is call:  # The scheduler thread is waiting on a later deadline
+                self._condition.notify()
+        return call
+
+    def cancel(self, call):
+        with self._condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            if not call.queued:  # Already popped (e.g. cancelled from its own callback), nothing left in the heap
+                return
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) // 2:
+                for entry in self._heap:
+                    if entry[2].cancelled:
+                        entry[2].queued = False
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+            self._condition.notify()
+
+    def _next_due(self):
+        """Wait until the earliest call is due and remove it from the heap, must hold the condition"""
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)[2].queued = False
+                self._cancelled -= 1
+            if not self._heap:
+                self._condition.wait(self.max_wait)
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._condition.wait(min(delay, self.max_wait))
+                continue
+            call = heapq.heappop(self._heap)[2]
+            call.queued = False
+            return call
+
+    @background
+    def _run(self):
+        while True:
+            with self._condition:
+                call = self._next_due()
+            try:
+                call.callback()
+            except Exception as e:
+                logging.error(f"TriggerScheduler: Error running scheduled trigger: {e}")
+                logging.exception(e)
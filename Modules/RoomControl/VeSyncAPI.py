@@ -25,7 +25,9 @@ class VeSyncAPI(RoomModule):
         email = secretes_table.get_row(secret_name='VesyncUsername')
         password = secretes_table.get_row(secret_name='VesyncPassword')
         self.manager = VeSync(email['secret_value'], password['secret_value'], time_zone='America/New_York')
+        self.devices = []
 
+    def warm_up(self):
         try:
             self.manager.login()
         except Exception as e:
@@ -34,7 +36,6 @@ class VeSyncAPI(RoomModule):
 
         self.manager.update()  # Populate the devices list
 
-        self.devices = []
         for device in self.manager.outlets:
             self.devices.append(VeSyncPlug(device, self.room_controller))
 
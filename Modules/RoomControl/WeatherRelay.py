@@ -1,5 +1,7 @@
+import json
 import math
 import os
+import threading
 import time
 
 from pyowm.owm import OWM
@@ -11,13 +13,22 @@ import requests
 from loguru import logger as logging
 
 from Modules.RoomControl import background
+from Modules.RoomControl.API.datagrams import APIMessageTX
 from Modules.RoomModule import RoomModule
-import pickle
 
 radar_index_url = "https://api.rainviewer.com/public/weather-maps.json"
 radar_base_url = "{host}/{path}/{size}/6/{x}/{y}/{color}/{options}.png"
 radar_tiles = [(x, y) for x in range(13, 21) for y in range(21, 25)]
 
+FORECAST_CACHE_PATH = "Cache/forecast.json"
+FORECAST_CACHE_VERSION = 1
+FORECAST_MAX_AGE = 720  # Seconds before a forecast is considered stale and is fetched again
+# The fields of each hourly forecast that are served by the API, these are the keys of pyowm's Weather.to_dict()
+FORECAST_FIELDS = ["reference_time", "sunset_time", "sunrise_time", "clouds", "rain", "snow", "wind", "humidity",
+                   "pressure", "temperature", "status", "detailed_status", "weather_code", "weather_icon_name",
+                   "visibility_distance", "dewpoint", "humidex", "heat_index", "utc_offset", "uvi",
+                   "precipitation_probability"]
+
 
 class WeatherRelay(RoomModule):
 
@@ -31,26 +42,26 @@ class WeatherRelay(RoomModule):
         self.actual_location = None
         self.current_weather = None
         self.current_reference_time = None
-        self.forecast = None
+        self.forecast_updated = 0  # When the loaded forecast was fetched from the API
+        self.forecast_loaded = False  # If the on disk forecast cache has been read yet
+        self.forecast_lock = threading.Lock()
+        self.forecast_index = {}  # type: dict[int, dict] # Hourly forecasts keyed by their reference time
+        self.forecast_payloads = {}  # type: dict[int, bytes] # Pre-encoded API responses for each hourly forecast
+        self.forecast_list_payload = None  # type: bytes # Pre-encoded API response for the available forecasts
         # self.location_address = "Milford, MI"
         # self.location_latlong = (42.5903, -83.5983)
-        self.location_address = geocoder.ip('me').address
-        self.location_latlong = geocoder.ip('me').latlng
-        logging.info(f"Location: {self.location_address} {self.location_latlong}")
-        if os.path.exists("Cache/forecast.pkl"):
-            with open("Cache/forecast.pkl", "rb") as file:
-                self.forecast = pickle.load(file)
-                self.forecast.last_update = time.time()
-                logging.info(f"Loaded forecast from cache {len(self.forecast.forecast_hourly)}")
-        if self.forecast is None:
-            # self.forecast = self.mgr.one_call(lat=47.112878, lon=-88.564697)
-            self.forecast = self.mgr.one_call(lat=self.location_latlong[0], lon=self.location_latlong[1])
-            logging.info(f"Loaded forecast for {len(self.forecast.forecast_hourly)} hourly forecasts"
-                         f" from the API")
-            os.makedirs("Cache", exist_ok=True)
-            pickle.dump(self.forecast, open("Cache/forecast.pkl", "wb"))
-            self.forecast.last_update = time.time()
+        self.location_address = None
+        self.location_latlong = None
         self.radar_fetch_background()
+
+    def warm_up(self):
+        # Read off the event loop before the location lookup so the cached forecast is served as soon as possible
+        self.load_forecast_cache()
+        location = geocoder.ip('me')
+        self.location_address = location.address
+        self.location_latlong = location.latlng
+        logging.info(f"Location: {self.location_address} {self.location_latlong}")
+        # The forecast is refreshed by the update thread so a stale cache never delays startup
         self.update_current_weather()
         self.update_forecast()
 
@@ -58,13 +69,13 @@ class WeatherRelay(RoomModule):
     def update_forecast(self):
         while True:
             try:
-                if time.time() - getattr(self.forecast, "last_update", 0) > 720:
+                self.load_forecast_cache()
+                if time.time() - self.forecast_updated > FORECAST_MAX_AGE:
                     logging.info("Updating forecast")
-                    self.forecast = self.mgr.one_call(lat=self.location_latlong[0], lon=self.location_latlong[1])
-                    self.forecast.last_update = time.time()
-                    pickle.dump(self.forecast, open("Cache/forecast.pkl", "wb"))
-                    # logging.info(f"Updated forecast for {self.forecast.reference_time(timeformat='iso')}")
-                    logging.info(f"Loaded {len(self.forecast.forecast_hourly)} hourly forecasts")
+                    forecast = self.mgr.one_call(lat=self.location_latlong[0], lon=self.location_latlong[1])
+                    self.index_forecast([hour.to_dict() for hour in forecast.forecast_hourly], time.time())
+                    self.save_forecast_cache()
+                    logging.info(f"Loaded {len(self.forecast_index)} hourly forecasts")
                 else:
                     logging.info("Forecast is up to date")
             except Exception as e:
@@ -72,6 +83,68 @@ class WeatherRelay(RoomModule):
             finally:
                 time.sleep(300)
 
+    def load_forecast_cache(self):
+        """
+        Loads the forecast from the on disk cache, this only happens once from warm_up (or the update thread if that
+        gets there first), the forecast endpoints only ever read the in memory index
+        """
+        with self.forecast_lock:
+            if self.forecast_loaded:
+                return
+            self.forecast_loaded = True
+            if not os.path.exists(FORECAST_CACHE_PATH):
+                return
+            try:
+                with open(FORECAST_CACHE_PATH, "r") as file:
+                    cache = json.load(file)
+                if cache.get("version") != FORECAST_CACHE_VERSION:
+                    logging.warning(f"Ignoring forecast cache with version {cache.get('version')}, "
+                                    f"expected {FORECAST_CACHE_VERSION}")
+                    return
+                # The cache is stored by column, rebuild one dict per hour from the columns
+                columns = cache["columns"]
+                hours = [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+                self.index_forecast(hours, cache["last_update"])
+                logging.info(f"Loaded forecast from cache {len(self.forecast_index)}")
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Failed to load forecast cache: {e}")
+
+    def save_forecast_cache(self):
+        """
+        Saves the served forecast fields to the on disk cache in a column oriented layout
+        """
+        hours = list(self.forecast_index.values())
+        cache = {
+            "version": FORECAST_CACHE_VERSION,
+            "last_update": self.forecast_updated,
+            "columns": {field: [hour.get(field) for hour in hours] for field in FORECAST_FIELDS}
+        }
+        os.makedirs(os.path.dirname(FORECAST_CACHE_PATH), exist_ok=True)
+        # Write to a temporary file first so a crash mid write can't leave a corrupt cache behind
+        with open(f"{FORECAST_CACHE_PATH}.tmp", "w") as file:
+            json.dump(cache, file, separators=(",", ":"))
+        os.replace(f"{FORECAST_CACHE_PATH}.tmp", FORECAST_CACHE_PATH)
+
+    def index_forecast(self, hours, last_update):
+        """
+        Builds the reference time index and the pre-encoded API responses for a forecast so that the
+        forecast endpoints don't have to search or serialize anything per request
+        :param hours: The hourly forecasts as dicts in the format of pyowm's Weather.to_dict()
+        :param last_update: When the forecast was fetched from the API
+        """
+        index = {}
+        payloads = {}
+        for forecast in hours:
+            index[forecast["reference_time"]] = forecast
+            payloads[forecast["reference_time"]] = \
+                APIMessageTX(weather_forecast=forecast).__str__().encode("utf-8")
+        list_payload = APIMessageTX(weather_forecast_list=list(index.keys())).__str__().encode("utf-8")
+        # Swap in the new index only once it is complete so requests never see a partially built index
+        self.forecast_index = index
+        self.forecast_payloads = payloads
+        self.forecast_list_payload = list_payload
+        self.forecast_updated = last_update
+
     @background
     def update_current_weather(self):
         while True:
@@ -241,10 +314,13 @@ class WeatherRelay(RoomModule):
         Returns the available forecast data
         :return:
         """
-        forecasts = []
-        for forecast in self.forecast.forecast_hourly:
-            forecasts.append(forecast.reference_time())
-        return forecasts
+        return list(self.forecast_index.keys())
+
+    def get_available_forecast_payload(self):
+        """
+        Returns the pre-encoded API response listing the available forecasts
+        """
+        return self.forecast_list_payload
 
     def get_forecast(self, forecast_time):
         """
@@ -252,7 +328,18 @@ class WeatherRelay(RoomModule):
         :param forecast_time: The time to get the forecast for
         :return: The forecast for the given time
         """
+        try:
+            return self.forecast_index.get(int(forecast_time))
+        except ValueError:
+            return None
 
-        for forecast in self.forecast.forecast_hourly:
-            if forecast.ref_time == int(forecast_time):
-                return forecast
+    def get_forecast_payload(self, forecast_time):
+        """
+        Returns the pre-encoded API response for the forecast at the given time
+        :param forecast_time: The time to get the forecast for
+        :return: The encoded forecast or None if there is no forecast for that time
+        """
+        try:
+            return self.forecast_payloads.get(int(forecast_time))
+        except ValueError:
+            return None
@@ -5,7 +5,6 @@ import sys
 
 import netifaces as netifaces
 from loguru import logger as logging
-import sqlite3
 import threading
 import os
 import time
@@ -17,25 +16,38 @@ from Modules.RoomControl.Decorators import background
 
 # Auto import modules that are in Modules/RoomControl that have a class that inherits RoomModule
 # This is done to make sure that all modules are dynamically loaded
+from Modules.EventBus import event_bus
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
+from Modules.StartupProfiler import startup_profiler
 
-for module in os.listdir("Modules/RoomControl"):
-    if module.endswith(".py") and module != "__init__.py":
-        module_name = module.replace(".py", "")
-        logging.info(f"Importing {module_name}")
-        try:
-            __import__(f"Modules.RoomControl.{module_name}", fromlist=[module_name])
-        except Exception as e:
-            logging.error(f"Error importing {module_name}: {e}")
-            logging.exception(e)
-    if os.path.isdir(f"Modules/RoomControl/{module}"):
-        logging.info(f"Importing {module}")
-        for module_file in os.listdir(f"Modules/RoomControl/{module}"):
-            if module_file.endswith(".py") and module_file != "__init__.py":
-                module_name = module_file.replace(".py", "")
-                logging.info(f"Importing {module_name} from {module}")
-                __import__(f"Modules.RoomControl.{module}.{module_name}", fromlist=[module_name])
+
+def timed_import(module_path):
+    """Import a module and record how long the import took in the startup profiler"""
+    start = time.perf_counter()
+    try:
+        __import__(module_path, fromlist=[module_path.split(".")[-1]])
+    finally:
+        startup_profiler.record_import(module_path, time.perf_counter() - start)
+
+
+with startup_profiler.phase("module_imports"):
+    for module in os.listdir("Modules/RoomControl"):
+        if module.endswith(".py") and module != "__init__.py":
+            module_name = module.replace(".py", "")
+            logging.info(f"Importing {module_name}")
+            try:
+                timed_import(f"Modules.RoomControl.{module_name}")
+            except Exception as e:
+                logging.error(f"Error importing {module_name}: {e}")
+                logging.exception(e)
+        if os.path.isdir(f"Modules/RoomControl/{module}"):
+            logging.info(f"Importing {module}")
+            for module_file in os.listdir(f"Modules/RoomControl/{module}"):
+                if module_file.endswith(".py") and module_file != "__init__.py":
+                    module_name = module_file.replace(".py", "")
+                    logging.info(f"Importing {module_name} from {module}")
+                    timed_import(f"Modules.RoomControl.{module}.{module_name}")
 
 def get_local_ip():
     import socket
@@ -43,13 +55,6 @@ def get_local_ip():
     raise NotImplementedError
 
 
-def database_backup(status, remaining, total):
-    if remaining == 0:
-        logging.info(f"Database backup complete, {total} pages backed up")
-    else:
-        logging.info(f"Database backup {status}, {remaining} pages remaining")
-
-
 class ObjectPointer:
 
     def __init__(self, initial_ref):
@@ -71,26 +76,62 @@ class ObjectPointer:
 class RoomController:
 
     def __init__(self, db_path: str = "room_data.db"):
-        self.database = Database(db_path)
-        try:
-            self.backup_database = sqlite3.connect(f"{db_path}.bak")
-            self.database.backup(target=self.backup_database, progress=database_backup)
-        except sqlite3.OperationalError:
-            logging.warning("Backup database is already in use, skipping backup")
-        self.init_database()
+        self.db_path = db_path
+        with startup_profiler.phase("database_open"):
+            self.database = Database(db_path)
+        # Backups are taken in the background by the DatabaseBackup module
+        with startup_profiler.phase("init_database"):
+            self.init_database()
 
         # Find all subclasses of RoomModule and create an instance of them
         self.controllers = []
         self.room_objects = []
-        for room_module in RoomModule.__subclasses__():
-            logging.info(f"Creating instance of {room_module.__name__}")
-            # if room_module.__name__ != "SatelliteInterface":
-            #     continue
-            try:
-                room_module(self)
-            except Exception as e:
-                logging.error(f"Error creating instance of {room_module.__name__}: {e}")
-                logging.exception(e)
+        self.object_lock = threading.RLock()  # Modules attach objects from their warm up threads
+        self.object_generation = 0  # Incremented whenever an object is attached so caches of the objects can expire
+        self.event_bus = event_bus
+        created_modules = []
+        with startup_profiler.phase("module_construction"):
+            for room_module in RoomModule.__subclasses__():
+                logging.info(f"Creating instance of {room_module.__name__}")
+                # if room_module.__name__ != "SatelliteInterface":
+                #     continue
+                start = time.perf_counter()
+                try:
+                    created_modules.append(room_module(self))
+                except Exception as e:
+                    logging.error(f"Error creating instance of {room_module.__name__}: {e}")
+                    logging.exception(e)
+                    startup_profiler.record_module(room_module.__name__, failed=True)
+                finally:
+                    startup_profiler.record_module(room_module.__name__, construct=time.perf_counter() - start)
+        with startup_profiler.phase("module_warm_up"):
+            self.warm_up_modules(created_modules)
+
+    def warm_up_modules(self, modules):
+        """
+        Runs the warm up of every module concurrently and waits until they finish or their warm up timeout expires
+        :param modules: The modules that were created successfully
+        """
+        started = time.monotonic()
+        warm_ups = [(module, self._warm_up_module(module)) for module in modules]
+        for module, thread in warm_ups:
+            thread.join(max(0.0, started + module.warm_up_timeout - time.monotonic()))
+            if thread.is_alive():
+                logging.warning(f"{module.__class__.__name__} did not finish warming up within "
+                                f"{module.warm_up_timeout} seconds, continuing startup without it")
+                startup_profiler.record_module(module.__class__.__name__, timed_out=True)
+        logging.info(f"Module warm up finished in {time.monotonic() - started:.2f} seconds")
+
+    @background
+    def _warm_up_module(self, module):
+        start = time.perf_counter()
+        try:
+            module.warm_up()
+        except Exception as e:
+            logging.error(f"Error warming up {module.__class__.__name__}: {e}")
+            logging.exception(e)
+        finally:
+            startup_profiler.record_module(module.__class__.__name__, warm_up=time.perf_counter() - start)
 
     def init_database(self):
         # cursor = self.database.cursor()
@@ -124,17 +165,23 @@ class RoomController:
     def attach_object(self, device: RoomObject):
         if not issubclass(type(device), RoomObject):
             raise TypeError(f"Device {device} is not a subclass of RoomObject")
-        # Check if the device exists as a promise object and replace it with the real object without changing the
-        # reference So that any references to the promise object are updated to the real object
-        for i, room_object in enumerate(self.room_objects):
-            if room_object.object_name == device.object_name:
-                logging.info(f"Replacing promise object {room_object.object_name} with real object")
-                # Make sure that we copy the callbacks from the promise object to the real object
-                device._callbacks = room_object._callbacks
-                self.room_objects[i].reference = device  # Replace the promise object with the real object
-                return
-        logging.info(f"Attaching object {device.object_name} to room controller")
-        self.room_objects.append(device)
+        with self.object_lock:
+            # Check if the device exists as a promise object and replace it with the real object without changing the
+            # reference So that any references to the promise object are updated to the real object
+            for i, room_object in enumerate(self.room_objects):
+                if room_object.object_name == device.object_name:
+                    logging.info(f"Replacing promise object {room_object.object_name} with real object")
+                    # Make sure that we copy the callbacks from the promise object to the real object, keeping any
+                    # callbacks the real object attached to itself while it was being created
+                    for event_name, callbacks in device._callbacks.items():
+                        room_object._callbacks[event_name] = room_object._callbacks.get(event_name, []) + callbacks
+                    device._callbacks = room_object._callbacks
+                    self.room_objects[i].reference = device  # Replace the promise object with the real object
+                    self.object_generation += 1
+                    return
+            logging.info(f"Attaching object {device.object_name} to room controller")
+            self.room_objects.append(device)
+            self.object_generation += 1
 
     def get_all_devices(self):
         return self.room_objects
@@ -149,12 +196,14 @@ class RoomController:
         return self.controllers
 
     def get_object(self, device_name, create_if_not_found=True):
-        for device in self.room_objects:
-            if device.object_name == device_name:
-                return self.room_objects[self.room_objects.index(device)]  # Return the reference to the object
-        if create_if_not_found:
-            self.room_objects.append(self._create_promise_object(device_name))
-            return self.room_objects[-1]
+        with self.object_lock:
+            for device in self.room_objects:
+                if device.object_name == device_name:
+                    return self.room_objects[self.room_objects.index(device)]  # Return the reference to the object
+            if create_if_not_found:
+                self.room_objects.append(self._create_promise_object(device_name))
+                self.object_generation += 1
+                return self.room_objects[-1]
         return None
 
     def get_all_objects(self):
@@ -4,7 +4,17 @@ class RoomModule:
 
     search_name = None
     search_type = None
+    warm_up_timeout = 30  # Seconds startup will wait for warm_up before continuing without this module
 
     def __init__(self, room_controller):
         self.room_controller = room_controller
         self.room_controller.attach_module(self)
+
+    def warm_up(self):
+        """
+        Called once every module has been registered, modules should do any slow initialization (e.g. logging into
+        a cloud service) here instead of in __init__ as all modules are warmed up concurrently
+        If this takes longer than warm_up_timeout startup continues and the warm up finishes in the background, any
+        objects it attaches will replace the promise objects that were handed out in the meantime
+        """
+        pass
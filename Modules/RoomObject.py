@@ -1,5 +1,92 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from loguru import logger as logging
 
+from Modules.EventBus import event_bus
+
+# Runs the callbacks attached with dispatch="executor" so slow callbacks don't hold up the object emitting the event
+event_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="RoomObjectEvents")
+
+
+class EventCallback:
+    """A callback attached to a RoomObject event, how it is dispatched and how it has performed"""
+
+    def __init__(self, callback, event_name, dispatch, loop=None):
+        """
+        :param callback: The function (or coroutine function) to call
+        :param event_name: The name of the event
+        :param dispatch: "inline" to call on the emitting thread, "executor" to call on the event executor or
+         "async" to schedule the coroutine on loop
+        :param loop: The event loop coroutine callbacks are scheduled on
+        """
+        self.callback = callback
+        self.event_name = event_name
+        self.dispatch = dispatch
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_error = None
+
+    def name(self):
+        return getattr(self.callback, "__qualname__", repr(self.callback))
+
+    def __call__(self, *args, **kwargs):
+        match self.dispatch:
+            case "executor":
+                event_executor.submit(self._run, args, kwargs)
+            case "async":
+                asyncio.run_coroutine_threadsafe(self._run_async(args, kwargs), self.loop)
+            case _:
+                self._run(args, kwargs)
+
+    def _run(self, args, kwargs):
+        start = time.perf_counter()
+        try:
+            self.callback(*args, **kwargs)
+        except Exception as e:
+            self._record(time.perf_counter() - start, e)
+        else:
+            self._record(time.perf_counter() - start)
+
+    async def _run_async(self, args, kwargs):
+        start = time.perf_counter()
+        try:
+            await self.callback(*args, **kwargs)
+        except Exception as e:
+            self._record(time.perf_counter() - start, e)
+        else:
+            self._record(time.perf_counter() - start)
+
+    def _record(self, elapsed, error=None):
+        with self.lock:
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if error is not None:
+                self.errors += 1
+                self.last_error = str(error)
+        if error is not None:
+            logging.error(f"RoomObject: Error in {self.event_name} callback {self.name()}: {error}")
+            logging.exception(error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "callback": self.name(),
+                "dispatch": self.dispatch,
+                "calls": self.calls,
+                "errors": self.errors,
+                "average_ms": round(self.total_time / self.calls * 1000, 3) if self.calls else 0,
+                "max_ms": round(self.max_time * 1000, 3),
+                "last_error": self.last_error,
+            }
+
 
 class RoomObject:
     object_type = "RoomObject"
@@ -13,7 +100,7 @@ class RoomObject:
         self.object_type = device_type
 
         # The following are only implemented on objects that implement this new system of RoomObject
-        self._callbacks = []
+        self._callbacks = {}  # type: dict[str, list[EventCallback]]
         self._values = {}
         self._health = {}
 
@@ -34,18 +121,36 @@ class RoomObject:
 
     def update(self, data):
         """
-        Update the object with new data
+        Update the object with new data, change events are only delivered locally as the data came from the object
         """
-        self._health = data["health"]
+        if data["health"] != self._health:
+            self._health = data["health"]
+            self._emit_local("on_health_update", self._health)
         for key, value in data["data"].items():
-            # if self._values.get(key, None) != value:
-            #     self.emit_event(f"on_{key}_update", value)
-            self._values[key] = value
+            if self._values.get(key, None) != value:
+                self._values[key] = value
+                self._emit_local(f"on_{key}_update", value)
+
+    def apply_delta(self, data):
+        """
+        Apply a partial update, only the keys present are changed and the keys listed in "removed" are deleted
+        change events are only delivered locally like update
+        """
+        if "health" in data and data["health"] != self._health:
+            self._health = data["health"]
+            self._emit_local("on_health_update", self._health)
+        for key, value in data.get("data", {}).items():
+            if self._values.get(key, None) != value:
+                self._values[key] = value
+                self._emit_local(f"on_{key}_update", value)
+        for key in data.get("removed", ()):
+            if self._values.pop(key, None) is not None:
+                self._emit_local(f"on_{key}_update", None)
 
     def set_value(self, key, value):
         if self._values.get(key, None) != value:
+            self._values[key] = value  # Stored first so callbacks reading the value see the new one
             self.emit_event(f"on_{key}_update", value)
-        self._values[key] = value
 
     def get_values(self):
         return self._values
@@ -56,24 +161,58 @@ class RoomObject:
             return None
         return self._values[key]
 
-    def attach_event_callback(self, callback, event_name):
+    def attach_event_callback(self, callback, event_name, dispatch="inline", loop=None):
         """
         Attach a callback to an event that this object can emit
-        :param callback: The callback function to call
+        :param callback: The callback function to call, coroutine functions are scheduled on the event loop
         :param event_name: The name of the event to attach to (e.g. "on_motion")
+        :param dispatch: "inline" to call the callback on the emitting thread or "executor" to call it on a worker
+         thread, use "executor" for callbacks that block
+        :param loop: The event loop to run a coroutine callback on, defaults to the loop running when attached
+        :return: The EventCallback that can be passed to detach_event_callback
         """
-        self._callbacks.append((callback, event_name))
+        if asyncio.iscoroutinefunction(callback):
+            dispatch = "async"
+            if loop is None:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    raise ValueError(f"No event loop to run coroutine callback {callback} on")
+        event_callback = EventCallback(callback, event_name, dispatch, loop)
+        # The list is replaced rather than appended to so an emit in progress on another thread isn't affected
+        self._callbacks[event_name] = self._callbacks.get(event_name, []) + [event_callback]
+        return event_callback
+
+    def detach_event_callback(self, event_callback):
+        remaining = [cb for cb in self._callbacks.get(event_callback.event_name, []) if cb is not event_callback]
+        if remaining:
+            self._callbacks[event_callback.event_name] = remaining
+        else:
+            self._callbacks.pop(event_callback.event_name, None)
 
     def emit_event(self, event_name, *args, **kwargs):
         """
-        Emit an event to all attached callbacks
+        Emit an event to all attached callbacks and the subscribers on the event bus
         :param event_name: The name of the event to emit
         :param args: Any arguments to pass to the callback
         :param kwargs: Any keyword arguments to pass to the callback
         """
-        for callback, name in self._callbacks:
-            if name == event_name:
-                callback(*args, **kwargs)
+        self._emit_local(event_name, *args, **kwargs)
+
+    def _emit_local(self, event_name, *args, **kwargs):
+        """Emit an event to the attached callbacks and the event bus without any side effects of emit_event"""
+        self._dispatch_event(event_name, args, kwargs)
+        event_bus.publish(self.object_name, event_name, *args, **kwargs)
+
+    def _dispatch_event(self, event_name, args, kwargs):
+        """Call the callbacks attached to this object, a callback raising doesn't stop the others being called"""
+        for event_callback in self._callbacks.get(event_name, ()):
+            event_callback(*args, **kwargs)
+
+    def get_event_stats(self):
+        """Returns the call count, error count and timing of every attached callback by event name"""
+        return {event_name: [event_callback.stats() for event_callback in callbacks]
+                for event_name, callbacks in self._callbacks.items()}
 
     def __str__(self):
         return f"{self.object_name}={self.object_type}"
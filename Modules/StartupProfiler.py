@@ -0,0 +1,74 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger as logging
+
+
+class StartupProfiler:
+    """
+    Records where the time goes while the room controller boots, the wall time of each startup phase,
+    how long each module took to import, construct and warm up
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}  # type: dict[str, float]
+        self.imports = {}  # type: dict[str, float]
+        self.modules = {}  # type: dict[str, dict]
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as a startup phase
+        :param name: The name of the phase (e.g. "init_database")
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = round(seconds, 4)
+
+    def record_import(self, name, seconds):
+        with self.lock:
+            self.imports[name] = round(seconds, 4)
+
+    def record_module(self, name, **timings):
+        """
+        Record timings for a room module, timings for the same module are merged
+        :param name: The name of the module
+        :param timings: The timings to record (e.g. construct=0.1, warm_up=2.5)
+        """
+        with self.lock:
+            entry = self.modules.setdefault(name, {})
+            for key, value in timings.items():
+                entry[key] = round(value, 4) if isinstance(value, float) else value
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed": round(time.perf_counter() - self._started, 4),
+                "phases": dict(self.phases),
+                "imports": dict(sorted(self.imports.items(), key=lambda item: item[1], reverse=True)),
+                "modules": {name: dict(timings) for name, timings in self.modules.items()}
+            }
+
+    def log_report(self):
+        report = self.report()
+        logging.info(f"Startup took {report['elapsed']:.2f} seconds")
+        for name, seconds in report["phases"].items():
+            logging.info(f"Startup phase {name}: {seconds:.3f}s")
+        slowest = sorted(report["modules"].items(),
+                         key=lambda item: item[1].get("construct", 0) + item[1].get("warm_up", 0), reverse=True)
+        for name, timings in slowest:
+            logging.info(f"Startup module {name}: " + ", ".join(f"{key} {value}" for key, value in timings.items()))
+
+
+startup_profiler = StartupProfiler()
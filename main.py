@@ -5,6 +5,7 @@ import os
 from Modules import RoomControl
 import asyncio
 from Modules.RoomControl.Decorators import background
+from Modules.StartupProfiler import startup_profiler
 
 # Create a logs folder if it doesn't exist and make sure its permissions are correct
 if not os.path.exists("logs"):
@@ -15,7 +16,8 @@ logging.remove()
 logging.add(sys.stdout, level="INFO")
 logging.add("logs/{time}.log", rotation="1 week", retention="1 hour", compression="zip", level="WARNING")
 
-room_controller = RoomControl.RoomController()
+with startup_profiler.phase("room_controller"):
+    room_controller = RoomControl.RoomController()
 
 
 async def main():
@@ -41,7 +43,8 @@ other_main()
 
 
 async def webserver_runner():
-    await asyncio.sleep(5)
+    with startup_profiler.phase("webserver_delay"):
+        await asyncio.sleep(5)
     logging.info("Starting asynchronous tasks")
     async_tasks = []
     for module in room_controller.get_modules():
@@ -66,6 +69,7 @@ async def webserver_runner():
                 logging.error(f"Error starting async module: {e}")
                 logging.exception(e)
 
+    startup_profiler.log_report()
     if len(async_tasks) > 0:
         await asyncio.gather(*async_tasks)
 